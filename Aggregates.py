@@ -0,0 +1,247 @@
+import math
+from operator import itemgetter
+
+from myutils import time_buckets
+
+class QuantileSketch(object):
+    """
+    Approximate distribution of non-negative numbers, from which any
+    quantile can be read to within a relative error of
+    @relative_accuracy. Values are counted in buckets whose bounds grow
+    geometrically, so the sketch stays small (a few hundred buckets
+    covering microseconds to days at 1%), and two sketches with the
+    same accuracy merge exactly, by adding their counts.
+    """
+
+    def __init__(self, relative_accuracy = 0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if value <= 0:
+            self.zeros += 1
+            return
+        i = int(math.ceil(math.log(value) / self.log_gamma))
+        self.bins[i] = self.bins.get(i, 0) + 1
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("can not merge sketches of different accuracy")
+        self.count += other.count
+        self.zeros += other.zeros
+        for i, n in other.bins.iteritems():
+            self.bins[i] = self.bins.get(i, 0) + n
+
+    def quantile(self, q):
+        """
+        Return the approximate @q quantile (0 <= @q <= 1), or None if
+        nothing was added
+        """
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for i in sorted(self.bins):
+            seen += self.bins[i]
+            if rank < seen:
+                return 2 * self.gamma ** i / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+class ValueStats(object):
+    """
+    Count, minimum, maximum, sum and (if @relative_accuracy is given) a
+    QuantileSketch of the values of one column in one group. None
+    values are not counted.
+    """
+    __slots__ = ('count', 'min', 'max', 'sum', 'sketch')
+
+    def __init__(self, relative_accuracy = None):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.sum = 0
+        self.sketch = None
+        if relative_accuracy is not None:
+            self.sketch = QuantileSketch(relative_accuracy)
+
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
+    def add(self, value):
+        if value is None:
+            return
+        if not self.count:
+            self.min = self.max = value
+        elif value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        self.count += 1
+        self.sum += value
+        if self.sketch is not None:
+            self.sketch.add(value)
+
+    def merge(self, other):
+        if not other.count:
+            return
+        if not self.count:
+            self.min, self.max = other.min, other.max
+        else:
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+        self.count += other.count
+        self.sum += other.sum
+        if self.sketch is not None:
+            self.sketch.merge(other.sketch)
+
+class Aggregation(object):
+    """
+    Roll the rows a Job outputs up into one row per distinct value of
+    the @keys columns (and, if @bucket is given, of @bucket(@time_column),
+    @bucket being the name of one of the time bucketing functions of
+    myutils, such as 'my_hour' or 'my_day'). Each row holds the number
+    of rows in its group, and the count, minimum, maximum and sum of
+    each of the numeric @values columns, and their @percentiles
+    (fractions, such as 0.95) estimated by a QuantileSketch of
+    @relative_accuracy.
+
+    The Job writes the rollup of each table to the table
+    <table>_<@name> of each Sink (see Job.aggregations). Aggregations
+    over different parts of a table, made by partial(), combine with
+    merge().
+    """
+
+    def __init__(self, name, keys, values = [], bucket = 'my_hour',
+                 time_column = 'event_time', percentiles = (0.5, 0.95, 0.99),
+                 relative_accuracy = 0.01):
+        if bucket is not None and bucket not in time_buckets:
+            raise ValueError("unknown time bucket {0!r}".format(bucket))
+        self.name = name
+        self.keys = list(keys)
+        self.values = list(values)
+        self.bucket = bucket
+        self.time_column = time_column
+        self.percentiles = list(percentiles)
+        self.relative_accuracy = relative_accuracy
+        self.groups = {}
+
+    @property
+    def inputs(self):
+        """
+        The columns this Aggregation reads
+        """
+        return ([self.time_column] if self.bucket else []) + self.keys + \
+            self.values
+
+    def partial(self):
+        """
+        Return a new, empty Aggregation of the same kind
+        """
+        return Aggregation(self.name, self.keys, self.values, self.bucket,
+                           self.time_column, self.percentiles,
+                           self.relative_accuracy)
+
+    def _new_group(self):
+        accuracy = self.relative_accuracy if self.percentiles else None
+        return [0] + [ValueStats(accuracy) for col in self.values]
+
+    def compile(self, column_index):
+        """
+        Return a function which adds a batch of list-backed rows, laid
+        out as in @column_index, to the groups, and returns the batch
+        """
+        key_idx = [column_index[col] for col in self.keys]
+        if len(key_idx) == 1:
+            k, = key_idx
+            get_key = lambda row: (row[k],)
+        elif key_idx:
+            get_key = itemgetter(*key_idx)
+        else:
+            get_key = lambda row: ()
+        value_idx = [column_index[col] for col in self.values]
+        bucket = time_buckets[self.bucket] if self.bucket else None
+        time_idx = column_index[self.time_column] if bucket else None
+        groups = self.groups
+        new_group = self._new_group
+        # rows come mostly in time order, so the bucket of the last
+        # event_time is usually the one needed
+        last = [None, None]
+
+        def add(batch):
+            for row in batch:
+                key = get_key(row)
+                if bucket is not None:
+                    event_time = row[time_idx]
+                    if event_time != last[0]:
+                        last[0] = event_time
+                        last[1] = None if event_time is None \
+                            else bucket(event_time)
+                    key = (last[1],) + key
+                group = groups.get(key)
+                if group is None:
+                    group = groups[key] = new_group()
+                group[0] += 1
+                for i, stats in zip(value_idx, group[1:]):
+                    stats.add(row[i])
+            return batch
+        return add
+
+    def merge(self, other):
+        """
+        Add the groups of @other, an Aggregation of the same kind, to
+        these. Groups are taken over rather than copied, so @other
+        should not be used afterwards.
+        """
+        for key, group in other.groups.iteritems():
+            mine = self.groups.get(key)
+            if mine is None:
+                self.groups[key] = group
+                continue
+            mine[0] += group[0]
+            for stats, other_stats in zip(mine[1:], group[1:]):
+                stats.merge(other_stats)
+
+    def outputs(self, types = {}):
+        """
+        Return the columns of the rollup as (column, sql type) pairs;
+        key columns have their type in the dict @types, or MEDIUMTEXT
+        """
+        columns = [(self.bucket, 'INT')] if self.bucket else []
+        columns.extend((col, types.get(col, 'MEDIUMTEXT'))
+                       for col in self.keys)
+        columns.append(('count', 'BIGINT'))
+        for col in self.values:
+            columns.extend([(col + '_count', 'BIGINT'),
+                            (col + '_min', 'DOUBLE'),
+                            (col + '_max', 'DOUBLE'),
+                            (col + '_sum', 'DOUBLE')])
+            columns.extend(('{0}_p{1:g}'.format(col, q * 100).replace('.', '_'),
+                            'DOUBLE')
+                           for q in self.percentiles)
+        return columns
+
+    def rows(self):
+        """
+        Generator over the rows of the rollup, as tuples in the order of
+        outputs(), sorted by group
+        """
+        for key in sorted(self.groups):
+            group = self.groups[key]
+            row = list(key)
+            row.append(group[0])
+            for stats in group[1:]:
+                row.extend([stats.count, stats.min, stats.max,
+                            stats.sum if stats.count else None])
+                row.extend(stats.sketch.quantile(q) for q in self.percentiles)
+            yield tuple(row)
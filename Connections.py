@@ -0,0 +1,151 @@
+import os
+
+# where a Job reads and writes by default
+DEFAULT_ENDPOINT = {"host": "localhost",
+                    "user": "root",
+                    "passwd": "",
+                    "unix_socket": "/u1/vbar/mysql/thesock"}
+
+class ConnectionFactory(object):
+    """
+    Callable opening new connections to one MySQL server, with the
+    keyword arguments @params of MySQLdb.connect() (host, port, user,
+    passwd, unix_socket, ...). Calling it with a cursor class makes
+    that the default cursor class of the connection.
+    """
+
+    def __init__(self, **params):
+        self.params = params
+
+    def __call__(self, cursorclass = None):
+        # imported here, so that Jobs reading files need no MySQL driver
+        import MySQLdb as mysql
+        from MySQLdb.cursors import Cursor
+
+        params = dict(self.params)
+        params['cursorclass'] = cursorclass or Cursor
+        return mysql.connect(**params)
+
+class ConnectionPool(object):
+    """
+    Connections opened by @connect (a ConnectionFactory, or any
+    callable returning a new connection), handed out by get() and
+    returned by put(), which keeps up to @size of them open for reuse.
+
+    A pool can be inherited by forked processes: a process never reuses
+    connections that were opened by another one.
+    """
+
+    def __init__(self, connect, size = 4):
+        self.connect = connect
+        self.size = size
+        self.idle = []
+        self.pid = os.getpid()
+        # connections inherited from the parent process, never used or
+        # closed here
+        self._inherited = []
+
+    def _check_pid(self):
+        if self.pid != os.getpid():
+            # the parent's connections share their sockets with the
+            # parent; freeing one would close it, sending the server a
+            # COM_QUIT that ends the parent's session, so keep them
+            # referenced for the life of this process
+            self._inherited.extend(self.idle)
+            self.idle = []
+            self.pid = os.getpid()
+
+    def get(self):
+        """
+        Return an idle connection which is still alive, or a new one
+        """
+        self._check_pid()
+        while self.idle:
+            conn = self.idle.pop()
+            try:
+                conn.ping()
+                return conn
+            except Exception:
+                pass
+        return self.connect()
+
+    def put(self, conn):
+        """
+        Return @conn to the pool, discarding any transaction in progress
+        """
+        self._check_pid()
+        try:
+            conn.rollback()
+        except Exception:
+            # not fit for reuse (it may be in the middle of a result)
+            try:
+                conn.close()
+            except Exception:
+                pass
+            return
+        if len(self.idle) < self.size:
+            self.idle.append(conn)
+        else:
+            conn.close()
+
+    def close(self):
+        """
+        Close every idle connection
+        """
+        self._check_pid()
+        while self.idle:
+            self.idle.pop().close()
+
+    def tables(self, dbs):
+        """
+        Return a dict from each database in @dbs to the set of its
+        tables, all fetched by one information_schema query
+        """
+        tables = dict((db, set()) for db in dbs)
+        if not tables:
+            return tables
+        conn = self.get()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT table_schema, table_name "
+                        "FROM information_schema.tables "
+                        "WHERE table_schema IN ({0})".format(
+                            ', '.join(['%s'] * len(tables))),
+                        sorted(tables))
+            for db, table in cur.fetchall():
+                tables[db].add(table)
+            cur.close()
+        finally:
+            self.put(conn)
+        return tables
+
+def as_pool(connections):
+    """
+    Return @connections if it is a ConnectionPool, or else a pool of
+    connections opened by calling it
+    """
+    if isinstance(connections, ConnectionPool):
+        return connections
+    return ConnectionPool(connections)
+
+def list_tables(objects):
+    """
+    Return a dict from each of @objects (Sources or Sinks) to the set
+    of its tables. The tables of those in MySQL (which have db and
+    connections attributes) are fetched with one query per
+    ConnectionPool; the others are asked through their tables()
+    method.
+    """
+    by_pool = {}
+    tables = {}
+    for obj in objects:
+        pool = getattr(obj, 'connections', None)
+        if isinstance(pool, ConnectionPool) and getattr(obj, 'db', None):
+            by_pool.setdefault(pool, []).append(obj)
+        else:
+            tables[obj] = set(obj.tables())
+    for pool, pool_objects in by_pool.iteritems():
+        pool_tables = pool.tables(set(obj.db for obj in pool_objects))
+        for obj in pool_objects:
+            tables[obj] = pool_tables[obj.db]
+    return tables
@@ -6,3 +6,12 @@ class SkipRowException(Exception):
 
 class InvalidInputOutputOrderException(Exception):
     pass
+
+class StatefulProcessorException(Exception):
+    pass
+
+class ShardException(Exception):
+    pass
+
+class InvalidRangeException(Exception):
+    pass
@@ -1,19 +1,134 @@
 import os
-import MySQLdb as mysql
-from MySQLdb.cursors import DictCursor
+import sys
+import json
+import time
+import cProfile
+import traceback
+import multiprocessing
+import Queue
+import cPickle as pickle
+from collections import deque
+from datetime import datetime, timedelta
 
+from itertools import izip, compress, chain, islice
 from operator import itemgetter
 
-from Exceptions import InvalidSortException, SkipRowException, InvalidInputOutputOrderException
-from myutils import print_and_execute
+from Exceptions import InvalidSortException, SkipRowException, InvalidInputOutputOrderException, ShardException, InvalidRangeException
+from Processors import BaseProcessor
+from Sources import GENERAL_LOG_COLUMNS, MySQLSource
+from Sinks import MySQLSink
+from Connections import ConnectionFactory, DEFAULT_ENDPOINT, as_pool, list_tables
+from myutils import external_sort, chunked, merge_sorted, time_ranges, PipelineProfile, StepStats
+
+# how recent the newest row of a table must be for it to be held back
+# when running incrementally (see Job._track_high_water)
+LIVE_LOG_SLACK = timedelta(days = 1)
+
+class ProcessorGroup(list):
+    """
+    A list of consecutive Processors of a Job's pipeline, the first of
+    them at index @start (see Job._sort_schema). A Processor may be in
+    the pipeline more than once, so its index there is not enough.
+    """
+
+    def __init__(self, start, processors = ()):
+        super(ProcessorGroup, self).__init__(processors)
+        self.start = start
+
+class RowView(object):
+    """
+    Dict-like, read-only view of a list-backed row, for Prefilters and
+    Processors that look columns up by name with row.get() or row[col].
+    One view is reused for many rows by reassigning its values.
+    """
+    __slots__ = ('index', 'values')
+
+    def __init__(self, index, values = None):
+        self.index = index
+        self.values = values
+
+    def get(self, col, default = None):
+        i = self.index.get(col)
+        if i is None:
+            return default
+        return self.values[i]
+
+    def __getitem__(self, col):
+        return self.values[self.index[col]]
+
+    def __contains__(self, col):
+        return col in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+def _takes_values(processor):
+    """
+    Return True if @processor's process() just forwards to
+    process_values(), so it can be handed its inputs positionally
+    """
+    process = getattr(type(processor), 'process', None)
+    return getattr(process, 'im_func', None) is BaseProcessor.process.im_func
+
+def _defining_class(cls, name):
+    for klass in cls.__mro__:
+        if name in klass.__dict__:
+            return klass
+    return None
+
+def _takes_batches(processor):
+    """
+    Return True if @processor's class (or a base class) implements
+    process_batch(), and no subclass of that class overrides process()
+    or process_values(), which process_batch() would then bypass
+    """
+    cls = type(processor)
+    batch_cls = _defining_class(cls, 'process_batch')
+    if batch_cls is None or batch_cls is BaseProcessor:
+        return False
+    return all(issubclass(batch_cls, _defining_class(cls, name))
+               for name in ('process', 'process_values'))
+
+def _prunable(processor):
+    """
+    Return True if running @processor has no effect but its outputs:
+    it keeps no state, never rejects a row and is not sorted
+    """
+    return getattr(processor, 'stateless', False) and \
+        not getattr(processor, 'rejects', True) and \
+        not processor.sort_column and not processor.sql_sort_by
+
+def _can_move_before(processor, other):
+    """
+    Return True if @processor, a Processor which may reject rows and
+    runs right after @other, can run before @other with the same
+    result
+    """
+    return getattr(processor, 'stateless', False) and \
+        getattr(processor, 'rejects', True) and \
+        not processor.sort_column and not processor.sql_sort_by and \
+        _prunable(other) and \
+        all(_takes_values(proc) or _takes_batches(proc)
+            for proc in (processor, other)) and \
+        not set(processor.inputs) & set(other.outputs) and \
+        not set(processor.outputs) & set(other.inputs + other.outputs)
 
 class Job:
 
     def __init__(self, selectors = [], prefilters = [], processors = [],
-                 outputs = {}):
+                 outputs = {}, stream = False, batch_size = 10000,
+                 sort_buffer_rows = 1000000, temp_dir = None, workers = 1,
+                 group_workers = 1, chunk_size = 5000, state_file = None,
+                 loader = 'fifo', load_chunk_size = 1000, profile_dir = None,
+                 cprofile = None, cprofile_sample = 10,
+                 source_connections = None, target_connections = None,
+                 aggregations = [], row_output = True, optimize = True,
+                 range_hours = None, checkpoint_file = None):
         """
         selectors  - list of sql statements to be put in the WHERE clause
-                     of the query that selects data from the general_log
+                     of the query that selects data from the general_log,
+                     either as strings or as (sql, params) pairs with %s
+                     placeholders for params (see Selectors.py)
 
         prefilters - list of Prefilter functions to use in this Job
 
@@ -22,20 +137,201 @@ class Job:
         outputs    - list of tuples of (output column, type) where types
                      are specified as sql types (such as in a table
                      schema definition)
+
+        stream     - if True, read the general_log through an unbuffered
+                     server-side cursor and push rows through the
+                     Prefilters and Processors as they arrive, rather
+                     than loading the whole table into memory first.
+                     Rows are only materialized in full where a
+                     Processor with a sort_column needs them sorted.
+
+        batch_size - number of rows fetched from the server at a time
+                     when streaming
+
+        sort_buffer_rows - the most rows to hold in memory when sorting
+                     for a Processor's sort_column. Larger tables are
+                     sorted in runs which are spilled to temporary files
+                     in temp_dir (default: the system temp directory)
+                     and merged back together.
+
+        workers    - number of processes to reduce tables in. Each table
+                     is reduced independently by one worker, over that
+                     worker's own connection.
+
+        group_workers - number of processes to run stateless Processors
+                     in (see BaseProcessor.stateless) when tables are
+                     reduced one at a time (workers = 1). Rows are sent
+                     to the workers in chunks of chunk_size rows and
+                     reassembled in order; other Processors still run in
+                     the main process. A group of Processors sorted
+                     by a Processor with a partition_key (see
+                     BaseProcessor) is instead split into group_workers
+                     shards by that column, each sorted and processed
+                     in its own process.
+
+        chunk_size - number of rows each Processor is run on at a time
+                     (see BaseProcessor.process_batch)
+
+        state_file - path of a .glpjob file in which to keep the state
+                     of the Job between runs. If given, the Job runs
+                     incrementally: it records how far each table has
+                     been reduced, by event_time, and the next run
+                     selects only the rows after that and appends them
+                     to the existing target table. If the newest
+                     event_time is recent, the rows at that time are
+                     held back for the next run, as more may still be
+                     logged in the same second. The
+                     state of each Processor (see
+                     BaseProcessor.get_state) is saved too, and
+                     restored on the next run.
+
+        loader     - how rows are loaded into the target database while
+                     they are being processed: 'fifo' runs LOAD DATA
+                     LOCAL INFILE on a named pipe (see
+                     Loaders.FifoLoader); 'insert' uses multi-row
+                     INSERTs of load_chunk_size rows (see
+                     Loaders.InsertLoader)
+
+        profile_dir - directory in which to write a JSON report of each
+                     table reduced: the wall and CPU time of each stage
+                     (fetching, prefiltering, sorting, each group of
+                     Processors) and of each Prefilter, Processor and
+                     Sink, the rows each was given and kept, and the
+                     peak memory use (see myutils.PipelineProfile).
+                     Processors run in the row pool or in shards are
+                     only timed as a whole, by the stage they are in,
+                     and Processors fused into one step (see
+                     _compile_fused()) are timed together.
+
+        cprofile   - one of the Processors of this Job to run under
+                     cProfile, one batch in every cprofile_sample; the
+                     statistics are written next to the JSON report, as
+                     <table>.pstats
+
+        source_connections - where to read the general_log from: a
+                     Connections.ConnectionPool, or a callable opening
+                     new connections, such as a
+                     Connections.ConnectionFactory (by default, one for
+                     Connections.DEFAULT_ENDPOINT). Connections are
+                     reused from table to table and from run to run.
+
+        target_connections - where to write the processed log, in the
+                     same form (by default, the source_connections)
+
+        aggregations - list of Aggregations (see Aggregates.py) to roll
+                     the processed rows of each table up into, in
+                     memory; each rollup is written to the Sinks as
+                     the table <table>_<aggregation name>, after the
+                     rows themselves. When running incrementally, the
+                     rollup of each run's new rows is appended.
+
+        row_output - if False, only the rollups of the aggregations are
+                     written, not the rows
+
+        optimize   - if True, plan how the Processors run (see _plan()
+                     and explain()): leave out those whose outputs are
+                     never used, and move rejecting ones as early as
+                     their inputs allow
+
+        range_hours - if given, split each table named after a month
+                     (such as 2013_03; see myutils.time_ranges) into
+                     event_time ranges of this many hours, each read,
+                     processed and loaded on its own. Ranges, rather
+                     than tables, are then what the workers take on.
+                     A range is loaded in one transaction, replacing
+                     any rows of that range a failed run loaded, so
+                     the outputs must include event_time. Processors
+                     keep their state from one range to the next only
+                     when ranges are reduced in order (workers = 1),
+                     and then a range that fails ends the run for its
+                     table, to be resumed from there. Each range is
+                     sorted on its own, so sorted Processors must sort
+                     by event_time, ascending. Needs a checkpoint_file,
+                     and cannot be combined with state_file.
+
+        checkpoint_file - path of a file in which to record which
+                     ranges of each table are done, with the rollups
+                     of the aggregations so far, so that a run which
+                     is stopped resumes from the ranges not yet done.
+                     The rollups are written once every range of a
+                     table is done. With workers = 1 the state of the
+                     Processors is recorded too, and restored when
+                     resuming. A table checkpointed with other
+                     range_hours is reduced again from the start,
+                     replacing the rows loaded before.
         """
         self.selectors = selectors
         self.prefilters = prefilters
         self.processors = processors
         self.outputs = outputs
+        self.stream = stream
+        self.batch_size = batch_size
+        self.sort_buffer_rows = sort_buffer_rows
+        self.temp_dir = temp_dir
+        self.workers = workers
+        self.group_workers = group_workers
+        self.chunk_size = chunk_size
+        self.state_file = state_file
+        self.loader = loader
+        self.load_chunk_size = load_chunk_size
+        self.profile_dir = profile_dir
+        self.cprofile = cprofile
+        self.cprofile_sample = cprofile_sample
+        if source_connections is None:
+            source_connections = ConnectionFactory(**DEFAULT_ENDPOINT)
+        self.source_connections = as_pool(source_connections)
+        if target_connections is None:
+            self.target_connections = self.source_connections
+        else:
+            self.target_connections = as_pool(target_connections)
+        self.aggregations = aggregations
+        self.row_output = row_output
+        self.optimize = optimize
+        self.range_hours = range_hours
+        self.checkpoint_file = checkpoint_file
+        self.checkpoint = {}
+        self.high_water = {}
+        self._row_pool = None
+        self._step_cache = {}
 
         if not self._input_output_validate():
             raise InvalidInputOutputOrderException
-        
+        if range_hours and state_file:
+            raise InvalidRangeException("range_hours can not be used with "
+                                        "state_file")
+        # without a checkpoint, a table a failed run loaded in part
+        # would look done to the next one
+        if range_hours and not checkpoint_file:
+            raise InvalidRangeException("range_hours needs a "
+                                        "checkpoint_file")
+        if range_hours and row_output and \
+           'event_time' not in [col for col, typ in outputs]:
+            raise InvalidRangeException("range_hours needs event_time in "
+                                        "the outputs")
+
+        self.pipeline, self.plan_notes = self._plan()
+        if range_hours:
+            # ranges are reduced, and sorted, one at a time in time order,
+            # which only amounts to sorting the whole table by event_time
+            for processor in self.pipeline:
+                sql_sort_by = (processor.sql_sort_by or '').lower().split()
+                if (processor.sort_column and
+                    (processor.sort_column != 'event_time' or
+                     processor.sort_reverse)) or \
+                   sql_sort_by not in ([], ['event_time'],
+                                       ['event_time', 'asc']):
+                    raise InvalidRangeException(
+                        "range_hours can only be used with Processors "
+                        "sorted by event_time, ascending, not {0}".format(
+                            self._step_name(processor)))
+        self._compile_layout()
+
     def _sort_schema(self):
         """
         Returns the list of Processors broken into sublists separated by
         Processors that require sorting, such that the first Processor in
-        each sublist (except the first) requires sorting. Second return
+        each sublist (except the first) requires sorting. The sublists
+        are ProcessorGroups, which know where they start. Second return
         value is the sql sorting to use when selecting general_log data.
         Raises InvalidSortException if the sort order is invalid (sql sort
         after another sort, or two sql sorts)
@@ -43,12 +339,12 @@ class Job:
 
         found_sort = False
         sql_sort = ''
-        allprocs = [[]]
+        allprocs = [ProcessorGroup(0)]
 
-        for processor in self.processors:
+        for i, processor in enumerate(self.pipeline):
             if processor.sort_column:
                 found_sort = True
-                allprocs.append([processor])
+                allprocs.append(ProcessorGroup(i, [processor]))
             elif processor.sql_sort_by:
                 if found_sort:
                     raise InvalidSortException
@@ -70,114 +366,1276 @@ class Job:
 
         # TODO: Should there be some safeguard against this?
         """
-        cols = set(['event_time', 'user_host', 'thread_id', 'server_id',
-                    'command_type', 'argument'])
+        cols = set(GENERAL_LOG_COLUMNS)
         for proc in self.processors:
             for col in proc.inputs:
                 if col not in cols:
                     return False
             cols.update(proc.outputs)
+        for aggregation in self.aggregations:
+            for col in aggregation.inputs:
+                if col not in cols:
+                    return False
 
         return True
 
 
-    def _all_prefilters_pass(self, row):
+    def _plan(self):
         """
-        Return True if all of self.prefilters accept @row
+        Return the Processors in the order they are to run, and a list
+        of notes on how that differs from self.processors. Unless
+        self.optimize is False:
+
+        - a stateless Processor which never rejects rows is left out if
+          none of its outputs are used by a later Processor, an output
+          or an Aggregation;
+        - each stateless Processor which may reject rows is moved ahead
+          of the stateless, non-rejecting Processors before it, as long
+          as it does not need their outputs and they do not need its
+          own, so that fewer rows reach them.
+
+        Processors that override process() may read any column, so no
+        Processor before them is left out, and none is moved past them.
+        Sorted Processors stay where they are, and self.cprofile is
+        never left out.
         """
+        pipeline = list(self.processors)
+        notes = []
+        if not self.optimize:
+            return pipeline, notes
+
+        used = set(col for col, typ in self.outputs)
+        for aggregation in self.aggregations:
+            used.update(aggregation.inputs)
+        kept = []
+        for proc in reversed(pipeline):
+            if used is not None and _prunable(proc) and \
+               proc is not self.cprofile and \
+               not used.intersection(proc.outputs):
+                notes.append("left out {0}: its outputs {1} are not used".format(
+                    self._step_name(proc), ', '.join(proc.outputs)))
+                continue
+            kept.append(proc)
+            if used is None:
+                continue
+            if not (_takes_values(proc) or _takes_batches(proc)):
+                used = None
+                continue
+            used.update(proc.inputs)
+            used.update(col for col in (proc.sort_column,
+                                        getattr(proc, 'partition_key', None))
+                        if col)
+        pipeline = kept[::-1]
+
+        for i in xrange(len(pipeline)):
+            proc = pipeline[i]
+            j = i
+            while j > 0 and _can_move_before(proc, pipeline[j - 1]):
+                j -= 1
+            if j < i:
+                notes.append("moved {0} ahead of {1}".format(
+                    self._step_name(proc), ', '.join(
+                        self._step_name(other) for other in pipeline[j:i])))
+                pipeline.insert(j, pipeline.pop(i))
+        return pipeline, notes
+
+    def _raw_columns(self):
+        """
+        Return the general_log columns the Job reads, in table order:
+        those read by Prefilters (all of them, for a Prefilter which
+        does not declare its columns attribute) and Processors (all of
+        them, for a Processor which overrides process(), since it may
+        look up any column), those sorted on or used to track
+        incremental runs, and those output without a Processor
+        producing them
+        """
+        needed = set()
         for fil in self.prefilters:
-            if not fil(row):
-                return False
-        return True
+            needed.update(getattr(fil, 'columns', GENERAL_LOG_COLUMNS))
+        produced = set()
+        for proc in self.pipeline:
+            if _takes_values(proc) or _takes_batches(proc):
+                needed.update(proc.inputs)
+            else:
+                needed.update(GENERAL_LOG_COLUMNS)
+            if proc.sort_column:
+                needed.add(proc.sort_column)
+            if getattr(proc, 'partition_key', None):
+                needed.add(proc.partition_key)
+            produced.update(proc.outputs)
+        needed.update(col for col, typ in self.outputs if col not in produced)
+        for aggregation in self.aggregations:
+            needed.update(col for col in aggregation.inputs
+                          if col not in produced)
+        if self.state_file:
+            needed.add('event_time')
+
+        raw_columns = [col for col in GENERAL_LOG_COLUMNS if col in needed]
+        # a SELECT needs at least one column
+        return raw_columns or list(GENERAL_LOG_COLUMNS[:1])
+
+    def _compile_layout(self):
+        """
+        Fix the position of every column in a row: the raw general_log
+        columns the Job reads first (see _raw_columns()), then each new
+        output column in the order the Processors produce them. Rows
+        are lists in this layout.
+        """
+        self.raw_columns = self._raw_columns()
+        self.columns = list(self.raw_columns)
+        for proc in self.pipeline:
+            self.columns.extend(col for col in proc.outputs
+                                if col not in self.columns)
+        self.column_index = dict((col, i) for i, col in enumerate(self.columns))
+        self._padding = [None] * (len(self.columns) - len(self.raw_columns))
+
+    def _compile_fused(self, processors):
+        """
+        Return a function which runs each of @processors in turn on
+        each row of a batch (a list) of list-backed rows, storing their
+        outputs in place, and returns the rows which are not skipped.
+        The loop is generated as Python source, with the columns of
+        each Processor's inputs and outputs written in, so a row costs
+        one direct call per Processor.
+        """
+        index = self.column_index
+        namespace = {'SkipRowException': SkipRowException}
+        body = []
+        for n, processor in enumerate(processors):
+            if _takes_values(processor):
+                namespace['f{0}'.format(n)] = processor.process_values
+                call = 'f{0}({1})'.format(n, ', '.join(
+                    'row[{0}]'.format(index[col]) for col in processor.inputs))
+            else:
+                namespace['f{0}'.format(n)] = processor.process
+                namespace['v{0}'.format(n)] = RowView(index)
+                body.append('v{0}.values = row'.format(n))
+                call = 'f{0}(v{0})'.format(n)
+            if processor.outputs:
+                call = ''.join('row[{0}], '.format(index[col])
+                               for col in processor.outputs) + '= ' + call
+            body.append(call)
+
+        source = 'def fused(batch):\n' \
+                 '    kept = []\n' \
+                 '    keep = kept.append\n' \
+                 '    for row in batch:\n' \
+                 '        try:\n' + \
+                 ''.join('            {0}\n'.format(line) for line in body) + \
+                 '        except SkipRowException:\n' \
+                 '            continue\n' \
+                 '        keep(row)\n' \
+                 '    return kept\n'
+        name = ' + '.join(self._step_name(processor) for processor in processors)
+        exec compile(source, '<fused {0}>'.format(name), 'exec') in namespace
+        return namespace['fused']
+
+    def _compile_batch_step(self, processor):
+        """
+        Return a function which runs @processor on a batch (a list) of
+        list-backed rows, storing its outputs in place, and returns the
+        rows of the batch which are not skipped. Uses process_batch() if
+        the Processor implements it.
+        """
+        if not _takes_batches(processor):
+            return self._compile_fused([processor])
+
+        index = self.column_index
+        in_idx = [index[col] for col in processor.inputs]
+        out_idx = [index[col] for col in processor.outputs]
+        fn = processor.process_batch
+
+        def batch_step(batch):
+            outputs, keep = fn(*[[row[i] for row in batch] for i in in_idx])
+            for o, column in zip(out_idx, outputs):
+                for row, value in izip(batch, column):
+                    row[o] = value
+            if keep is None:
+                return batch
+            return list(compress(batch, keep))
+        return batch_step
+
+    def _make_rows(self, rows):
+        """
+        Generator over batches of self.chunk_size list-backed rows,
+        with room for every output column, made from the raw
+        general_log tuples of @rows
+        """
+        padding = self._padding
+        for batch in chunked(rows, self.chunk_size):
+            yield [list(row) + padding for row in batch]
+
+    def _compile_prefilter(self, fil):
+        """
+        Return a function which runs the Prefilter @fil on a batch of
+        list-backed rows, returning the rows it accepts
+        """
+        view = RowView(self.column_index)
+        def batch_step(batch):
+            kept = []
+            for row in batch:
+                view.values = row
+                if fil(view):
+                    kept.append(row)
+            return kept
+        return batch_step
+
+    def _units(self, start, stop):
+        """
+        Return the (start, stop) index ranges of self.pipeline[@start:@stop]
+        which run as one step: each Processor implementing
+        process_batch() on its own, and each run of other Processors
+        fused together (see _compile_fused()), if self.optimize is set
+        """
+        units = []
+        while start < stop:
+            end = start + 1
+            if self.optimize and not _takes_batches(self.pipeline[start]):
+                while end < stop and not _takes_batches(self.pipeline[end]):
+                    end += 1
+            units.append((start, end))
+            start = end
+        return units
+
+    def _runs(self, group, pooled):
+        """
+        Return the (start, stop, parallel) runs of self.pipeline that
+        make up @group, a group of Processors. If @pooled, there is a
+        row pool, which the runs of stateless Processors are sent to
+        (parallel is True); otherwise the group is one run.
+        """
+        start = group.start
+        stop = start + len(group)
+        if not pooled:
+            return [(start, stop, False)]
+        runs = []
+        while start < stop:
+            stateless = getattr(self.pipeline[start], 'stateless', False)
+            end = start + 1
+            while end < stop and \
+                  getattr(self.pipeline[end], 'stateless', False) == stateless:
+                end += 1
+            runs.append((start, end, stateless))
+            start = end
+        return runs
+
+    def _steps(self, start, stop):
+        """
+        Return the compiled batch steps for
+        self.pipeline[@start:@stop], one for each of its units (see
+        _units()), compiling them on first use
+        """
+        try:
+            return self._step_cache[start, stop]
+        except KeyError:
+            steps = []
+            for first, last in self._units(start, stop):
+                if last - first == 1:
+                    steps.append(self._compile_batch_step(self.pipeline[first]))
+                else:
+                    steps.append(self._compile_fused(self.pipeline[first:last]))
+            self._step_cache[start, stop] = steps
+            return steps
+
+    def _apply_steps(self, steps, batches, stats = None):
+        """
+        Generator: run each of @batches through @steps, yielding what is
+        left of each batch. If @stats, a list of StepStats (see
+        myutils), is given, the cost of each step is added to the
+        corresponding StepStats.
+        """
+        if stats is None:
+            for batch in batches:
+                for step in steps:
+                    batch = step(batch)
+                    if not batch:
+                        break
+                else:
+                    yield batch
+            return
+
+        steps = zip(steps, stats)
+        for batch in batches:
+            for step, step_stats in steps:
+                batch = step_stats.run(step, batch)
+                if not batch:
+                    break
+            else:
+                yield batch
+
+    def _apply_steps_parallel(self, start, stop, batches):
+        """
+        Generator: like _apply_steps() for self.pipeline[@start:@stop],
+        but @batches are sent to the row pool, and yielded back in their
+        original order. Only a few batches per worker are in flight at
+        once.
+        """
+        pending = deque()
+        for batch in batches:
+            pending.append(self._row_pool.apply_async(
+                _process_chunk_worker, ((start, stop, batch),)))
+            if len(pending) >= 2 * self.group_workers:
+                batch = pending.popleft().get()
+                if batch:
+                    yield batch
+        while pending:
+            batch = pending.popleft().get()
+            if batch:
+                yield batch
+
+    def _process_group(self, group, batches, stats):
+        """
+        Generator: run each of @batches through the Processors in
+        @group, yielding what is left of each batch. Runs of stateless
+        Processors are spread over the row pool, if there is one; the
+        others add their costs to @stats, a dict from each unit (see
+        _units()) to its StepStats.
+        """
+        for start, end, parallel in self._runs(group,
+                                               self._row_pool is not None):
+            if parallel:
+                batches = self._apply_steps_parallel(start, end, batches)
+            else:
+                batches = self._apply_steps(
+                    self._steps(start, end), batches,
+                    [stats[unit] for unit in self._units(start, end)])
+
+        for batch in batches:
+            yield batch
+        print "Done with one group of processors"
+
+    def _shardable(self, group):
+        """
+        Return True if @group, a group of Processors starting with a
+        sorted one, can be run in shards (see _process_sharded()): its
+        first Processor has a partition_key, which is known before the
+        group runs, every other Processor in it is stateless or has the
+        same partition_key, and tables are reduced one at a time with
+        group_workers > 1
+        """
+        key = getattr(group[0], 'partition_key', None)
+        if not key or self.workers > 1 or self.group_workers <= 1:
+            return False
+        start = group.start
+        known = set(self.raw_columns)
+        for processor in self.pipeline[:start]:
+            known.update(processor.outputs)
+        return key in known and \
+            all(getattr(processor, 'stateless', False) or
+                getattr(processor, 'partition_key', None) == key
+                for processor in group[1:])
+
+    def _process_sharded(self, group, batches):
+        """
+        Generator: sort @batches by the sort_column of the first
+        Processor in @group and run them through the Processors of the
+        group, like _process_group(), but in group_workers processes,
+        each given the rows whose partition_key values hash to it.
+
+        Rows come back in the order a single sort would give them: the
+        shards are merged on the sort column, with ties broken by the
+        order in which rows arrived. The states of the Processors in the
+        workers are merged back into those of this process, each key
+        taken from the worker that owned it.
+        """
+        n = self.group_workers
+        start = group.start
+        stop = start + len(group)
+        key_idx = self.column_index[group[0].partition_key]
+        sort_idx = self.column_index[group[0].sort_column]
+
+        inboxes = [multiprocessing.Queue(4) for i in xrange(n)]
+        outboxes = [multiprocessing.Queue(4) for i in xrange(n)]
+        workers = [multiprocessing.Process(target = _shard_worker,
+                                           args = (self, start, stop,
+                                                   inbox, outbox))
+                   for inbox, outbox in zip(inboxes, outboxes)]
+        try:
+            for worker in workers:
+                worker.daemon = True
+                worker.start()
+
+            # each row is tagged with its position in the input, to keep
+            # the merge stable
+            seq = 0
+            shards = [[] for i in xrange(n)]
+            for batch in batches:
+                for row in batch:
+                    row.append(seq)
+                    seq += 1
+                    i = hash(row[key_idx]) % n
+                    shards[i].append(row)
+                    if len(shards[i]) >= self.chunk_size:
+                        _put_shard(workers[i], inboxes[i], shards[i], i)
+                        shards[i] = []
+            for i, (worker, inbox, shard) in enumerate(zip(workers, inboxes,
+                                                           shards)):
+                if shard:
+                    _put_shard(worker, inbox, shard, i)
+                _put_shard(worker, inbox, None, i)
+
+            states = [None] * n
+            rows = merge_sorted([_shard_rows(worker, outbox, states, i)
+                                 for i, (worker, outbox)
+                                 in enumerate(zip(workers, outboxes))],
+                                key = itemgetter(sort_idx),
+                                reverse = group[0].sort_reverse,
+                                tiebreak = itemgetter(-1))
+            for batch in chunked(rows, self.chunk_size):
+                for row in batch:
+                    row.pop()
+                yield batch
+
+            for worker in workers:
+                worker.join()
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+
+        for processor, worker_states in zip(group, zip(*states)):
+            if not getattr(processor, 'partition_key', None) or \
+               all(state is None for state in worker_states):
+                continue
+            merged = {}
+            for i, state in enumerate(worker_states):
+                if state:
+                    merged.update((key, value) for key, value in state.iteritems()
+                                  if hash(key) % n == i)
+            processor.set_state(merged)
+        print "Done with one group of processors"
+
+    def cache_stats(self):
+        """
+        Return a list of (processor, hits, misses, size) for each
+        Processor with a cache (see Processors.MemoizedProcessor). When
+        stateless Processors run in the row pool, each worker keeps its
+        own cache, whose counts are not included.
+        """
+        return [(processor, processor.cache.hits, processor.cache.misses,
+                 len(processor.cache))
+                for processor in self.processors
+                if getattr(processor, 'cache', None) is not None]
 
-    def _tables_to_reduce(self, target_db, source_db):
+    def rejection_stats(self):
         """
-        Return the tables in @source_db but not in @target_db
+        Return a list of (prefilter or processor, hits, kind, pattern)
+        for each rule of each Prefilter and Processor with a rejection
+        engine (see myutils.RejectionEngine) that has rejected rows of
+        the table being reduced, most hits first. As with
+        cache_stats(), rows rejected in the row pool are not counted.
         """
-        conn = mysql.connect(**{"host": "localhost",
-                                "user": "root",
-                                "passwd": "",
-                                "unix_socket": "/u1/vbar/mysql/thesock"})
-        cur = conn.cursor()
+        stats = []
+        for engine, step in self._rejection_engines():
+            stats.extend((step, hits, kind, pattern)
+                         for hits, kind, pattern in engine.stats())
+        stats.sort(key = itemgetter(1), reverse = True)
+        return stats
 
-        cur.execute("USE {0}".format(source_db))
-        cur.execute("SHOW TABLES")
-        gen_log_tables = set([x for x, in cur.fetchall()])
+    def _rejection_engines(self):
+        """
+        Return a list of (engine, step) for each Prefilter and Processor
+        with a rejection engine
+        """
+        return [(step.engine, step)
+                for step in list(self.prefilters) + list(self.processors)
+                if getattr(step, 'engine', None) is not None]
+
+    def _tables_to_reduce(self, source, sinks):
+        """
+        Return the tables of @source not yet in any of @sinks, plus,
+        when running incrementally, the tables of @source this Job has
+        already reduced, and the tables with ranges still to reduce
+        (see _load_checkpoint())
+        """
+        tables = list_tables([source] + list(sinks))
+        gen_log_tables = tables[source]
+        done = set()
+        for sink in sinks:
+            done.update(tables[sink])
+
+        return set(table for table in gen_log_tables
+                   if self._output_tables(table)[-1] not in done) | \
+               (gen_log_tables & set(self.high_water)) | \
+               (gen_log_tables & set(self.checkpoint))
+
+    def _output_tables(self, table):
+        """
+        Return the names of the tables written for @table, in the order
+        they are written
+        """
+        return ([table] if self.row_output else []) + \
+            ['{0}_{1}'.format(table, aggregation.name)
+             for aggregation in self.aggregations]
+
+    def _final_selector(self):
+        """
+        Return a function which picks the final output columns out of a
+        row, as a tuple
+        """
+        final_idx = [self.column_index[colname] for colname, coltype
+                     in self.outputs]
+        if len(final_idx) == 1:
+            return lambda row: (row[final_idx[0]],)
+        return itemgetter(*final_idx)
+
+    def _load_state(self):
+        """
+        Restore the high-water marks and Processor states saved in
+        self.state_file by _save_state(), if there are any
+        """
+        self.high_water = {}
+        if not self.state_file or not os.path.exists(self.state_file):
+            return
+        with open(self.state_file, 'rb') as infile:
+            state = pickle.load(infile)
+        self.high_water = state['high_water']
+        for table, mark in self.high_water.items():
+            # older state files kept an (event_time, thread_id) pair
+            if isinstance(mark, tuple):
+                print >>sys.stderr, "Rows of {0} logged at {1} may be " \
+                    "reduced again".format(table, mark[0])
+                self.high_water[table] = mark[0]
+        self._restore_processor_states(state['processors'], self.state_file)
 
-        cur.execute("USE {0}".format(target_db))
-        cur.execute("SHOW TABLES")
-        target_db_tables = set([x for x, in cur.fetchall()])
+    def _processor_states(self):
+        return [getattr(processor, 'get_state', lambda: None)()
+                for processor in self.processors]
 
-        tables = gen_log_tables - target_db_tables
+    def _restore_processor_states(self, states, filename):
+        """
+        Give each Processor its state in @states, saved by
+        _processor_states() in @filename
+        """
+        if len(states) != len(self.processors):
+            print >>sys.stderr, "Processors in {0} do not match this Job, " \
+                "not restoring their state".format(filename)
+            return
+        for processor, processor_state in zip(self.processors, states):
+            if processor_state is not None:
+                processor.set_state(processor_state)
 
-        cur.close()
-        conn.close()
+    def _save_state(self):
+        """
+        Write the high-water marks and the state of each Processor to
+        self.state_file, replacing it atomically
+        """
+        temp_filename = self.state_file + '.tmp'
+        with open(temp_filename, 'wb') as outfile:
+            pickle.dump({'high_water': self.high_water,
+                         'processors': self._processor_states()},
+                        outfile, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_filename, self.state_file)
 
-        return tables
-            
+    def _load_checkpoint(self):
+        """
+        Restore self.checkpoint, a dict from each table whose ranges are
+        being reduced (see range_hours) to a dict of 'range_hours', the
+        size of its ranges, 'done', the set of its ranges which are
+        done, 'started', the set of those which may have been loaded in
+        part, 'aggregations', the merged rollups of the ranges done (or
+        None), and 'processors', the states of the Processors after the
+        last range done, if ranges are reduced in order (or None), from
+        self.checkpoint_file, if there is one
+        """
+        self.checkpoint = {}
+        if not self.checkpoint_file or not os.path.exists(self.checkpoint_file):
+            return
+        with open(self.checkpoint_file, 'rb') as infile:
+            self.checkpoint = pickle.load(infile)
+
+    def _save_checkpoint(self):
+        """
+        Write self.checkpoint to self.checkpoint_file, if there is one,
+        replacing it atomically
+        """
+        if not self.checkpoint_file:
+            return
+        temp_filename = self.checkpoint_file + '.tmp'
+        with open(temp_filename, 'wb') as outfile:
+            pickle.dump(self.checkpoint, outfile, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_filename, self.checkpoint_file)
 
-    def run(self, target_db, source_db = 'general_log'):
+    def _unit_name(self, table, between):
+        """
+        Return the name of the range @between of @table, or of the whole
+        table if @between is None
+        """
+        if between is None:
+            return table
+        start = between[0]
+        return '{0}.{1}'.format(table, start.strftime('%Y%m%d%H%M')
+                                if start is not None else 'start')
 
+    def _where(self, source):
+        """
+        Return the WHERE clause built from self.selectors and the SQL
+        equivalents of self.prefilters (see Prefilters.rejection_sql),
+        with %s placeholders for its parameters, and the parameters.
+        Selectors given as plain strings have % escaped as %%. If
+        @source can not apply SQL, returns an empty clause.
+        """
+        if not source.supports_sql:
+            return '', []
+        conditions = []
+        params = []
+        for sel in self.selectors:
+            if isinstance(sel, tuple):
+                sel, sel_params = sel
+                params.extend(sel_params)
+            else:
+                sel = sel.replace('%', '%%')
+            conditions.append('(' + sel + ')')
+        for fil in self.prefilters:
+            sql_where = getattr(fil, 'sql_where', None)
+            if sql_where:
+                clause, fil_params = sql_where
+                conditions.append('(' + clause + ')')
+                params.extend(fil_params)
+        if not conditions:
+            return '', []
+        return "WHERE " + " AND ".join(conditions), params
+
+    def _python_prefilters(self, source):
+        """
+        Return the Prefilters which have to be run in Python on rows
+        from @source: those which are not entirely done by the WHERE
+        clause
+        """
+        if not source.supports_sql:
+            return self.prefilters
+        return [fil for fil in self.prefilters
+                if not (getattr(fil, 'sql_where', None) and
+                        getattr(fil, 'sql_complete', False))]
+
+    def _track_high_water(self, batches, mark):
+        """
+        Generator over the rows of @batches, leaving in mark[0] the
+        event_time from which the next run selects rows. If the newest
+        event_time among them is recent (within LIVE_LOG_SLACK, which
+        allows for the server's clock and time zone), the log may still
+        be written to in that second, so the rows at that time are held
+        back, not passed on, and the next run, selecting rows from
+        mark[0] on, reduces them all together. Otherwise mark[0] is just
+        after the newest event_time.
+        """
+        event_time = self.column_index['event_time']
+        newest = None
+        held = []
+        for batch in batches:
+            passed = []
+            for row in batch:
+                logged = row[event_time]
+                if newest is None or logged > newest:
+                    passed.extend(held)
+                    held = [row]
+                    newest = logged
+                elif logged == newest:
+                    held.append(row)
+                else:
+                    passed.append(row)
+            if passed:
+                yield passed
+        if newest is None:
+            return
+        if newest >= datetime.now() - LIVE_LOG_SLACK:
+            mark[0] = newest
+            return
+        if held:
+            yield held
+        # event_time has at most microsecond precision
+        mark[0] = newest + timedelta(microseconds = 1)
+
+    def _step_name(self, step):
+        return getattr(step, '__name__', type(step).__name__)
+
+    def _write_profile(self, profile, stats):
+        """
+        Write the report of @profile, the PipelineProfile of a table,
+        as JSON to <profile_dir>/<table>.json, and the cProfile
+        statistics of self.cprofile, if any, to
+        <profile_dir>/<table>.pstats
+        """
+        if not os.path.isdir(self.profile_dir):
+            os.makedirs(self.profile_dir)
+        path = os.path.join(self.profile_dir, profile.table)
+        with open(path + '.json', 'w') as outfile:
+            json.dump(profile.report(), outfile, indent = 2)
+        for step_stats in stats:
+            if step_stats.profiler is not None:
+                step_stats.profiler.dump_stats(path + '.pstats')
+
+    def _write_table(self, sinks, sink_stats, table, outputs, batches,
+                     span = None, replace = False):
+        """
+        Write @batches, lists of tuples of the values of @outputs, to
+        each of @sinks as @table, adding the cost to @sink_stats. The
+        rows are appended if running incrementally. If @span is given,
+        they are the rows of that range of the table, and are appended
+        to it, replacing those already in the range if @replace is True
+        (see Sinks.MySQLSink). If anything fails, the Sinks are told to
+        abort the table.
+        """
+        append = bool(self.state_file)
+        begun = []
+        try:
+            for sink in sinks:
+                if span is None:
+                    sink.begin(table, outputs, append = append)
+                else:
+                    sink.begin(table, outputs, append = True, span = span,
+                               replace = replace)
+                begun.append(sink)
+            for batch in batches:
+                for sink, step_stats in zip(sinks, sink_stats):
+                    wall, cpu = time.time(), time.clock()
+                    sink.write(batch)
+                    step_stats.add(wall, cpu, len(batch), len(batch))
+            for sink, step_stats in zip(sinks, sink_stats):
+                wall, cpu = time.time(), time.clock()
+                sink.commit()
+                step_stats.add(wall, cpu, 0, 0)
+        except Exception:
+            for sink in begun:
+                try:
+                    sink.abort()
+                except Exception:
+                    traceback.print_exc()
+            raise
+
+    def _reduce_table(self, source, sinks, table, between = None,
+                      replace = False):
+        """
+        Read @table from @source, run it through the Prefilters and
+        Processors, and write the result to each of @sinks, as a new
+        table of the same name (or appended to that table, if running
+        incrementally). Rows are written as they come out of the last
+        Processor, and the rollups of self.aggregations once they all
+        have. Returns the table's new high-water mark, and a list of
+        the rollups not yet written.
+
+        If @between, a (start, end) event_time range, is given, only
+        the rows of @table in that range are reduced and appended to
+        the table, replacing those already there in that range if
+        @replace is True. The rollups are then not written, but
+        returned, to be merged with those of the other ranges.
+
+        The time spent in each stage and step is recorded in a
+        PipelineProfile (see myutils), written out if self.profile_dir
+        is set.
+        """
+        profile = PipelineProfile(self._unit_name(table, between))
+        for engine, step in self._rejection_engines():
+            engine.reset()
+        high_water = self.high_water.get(table)
         sort_schema, sql_sort_by = self._sort_schema()
-        sql_where = ( "WHERE " + " AND ".join('(' + sel + ')'
-                                              for sel in self.selectors) ) \
-                                                  if self.selectors else ''
-
-        final_selector = itemgetter(*[colname for colname, coltype
-                                      in self.outputs])
-
-        conn = mysql.connect(**{"host": "localhost",
-                                "user": "root",
-                                "passwd": "",
-                                "unix_socket": "/u1/vbar/mysql/thesock",
-                                "cursorclass": DictCursor})
-        cur = conn.cursor()
-            
-        for table in self._tables_to_reduce(target_db, source_db):
-            cur.execute("USE {0}".format(source_db))
-            sql_full = "SELECT * FROM {0} {1} {2}".format(table,
-                                                          sql_where,
-                                                          sql_sort_by)
-
-            print_and_execute(sql_full, cur)
-
-            rows = filter(self._all_prefilters_pass, cur.fetchall())
-
-            # TODO: can avoid using DictCursor by changing the above line
-
-            for group in sort_schema:
-                newrows = []
-                if group[0].sort_column:
-                    rows.sort(key=itemgetter(group[0].sort_column),
-                              reverse=group[0].sort_reverse)
-                for row in rows:
+        sql_where, params = self._where(source)
+        final_selector = self._final_selector()
+        prefilters = self._python_prefilters(source)
+        prefilter_stats = [profile.step('prefilter', self._step_name(fil))
+                           for fil in prefilters]
+        processor_stats = {}
+        for group in sort_schema:
+            if group[0].sort_column and self._shardable(group):
+                continue
+            for start, stop, parallel in self._runs(group,
+                                                    self._row_pool is not None):
+                if parallel:
+                    continue
+                for first, last in self._units(start, stop):
+                    processors = self.pipeline[first:last]
+                    profiler = None
+                    if any(processor is self.cprofile
+                           for processor in processors):
+                        profiler = cProfile.Profile()
+                    processor_stats[first, last] = profile.step(
+                        'processor', ' + '.join(self._step_name(processor)
+                                                for processor in processors),
+                        profiler, self.cprofile_sample)
+        sink_stats = [profile.step('sink', self._step_name(sink))
+                      for sink in sinks]
+        aggregations = [aggregation.partial()
+                        for aggregation in self.aggregations]
+        aggregation_stats = [profile.step('aggregation', aggregation.name)
+                             for aggregation in aggregations]
+
+        if between is None:
+            rows = source.rows(table, self.raw_columns, sql_where, params,
+                               sql_sort_by, since = high_water)
+        else:
+            rows = source.rows(table, self.raw_columns, sql_where, params,
+                               sql_sort_by, since = high_water,
+                               between = between)
+        batches = profile.timed('fetch', self._make_rows(rows))
+        mark = [high_water]
+        if self.state_file:
+            batches = self._track_high_water(batches, mark)
+        batches = profile.timed('prefilters', self._apply_steps(
+            [self._compile_prefilter(fil) for fil in prefilters], batches,
+            prefilter_stats))
+
+        # Chain the groups together lazily; a group whose first
+        # Processor needs sorting is the only place rows have to be
+        # buffered, and then at most sort_buffer_rows of them
+        for group in sort_schema:
+            if group[0].sort_column and self._shardable(group):
+                batches = profile.timed(
+                    'processors {0} (sharded by {1})'.format(
+                        ', '.join(self._step_name(processor)
+                                  for processor in group),
+                        group[0].partition_key),
+                    self._process_sharded(group, batches))
+                continue
+            if group[0].sort_column:
+                rows = external_sort(chain.from_iterable(batches),
+                                     key=itemgetter(self.column_index[
+                                         group[0].sort_column]),
+                                     reverse=group[0].sort_reverse,
+                                     buffer_size=self.sort_buffer_rows,
+                                     temp_dir=self.temp_dir)
+                batches = profile.timed('sort by ' + group[0].sort_column,
+                                        chunked(rows, self.chunk_size))
+            batches = profile.timed(
+                'processors ' + ', '.join(self._step_name(processor)
+                                          for processor in group),
+                self._process_group(group, batches, processor_stats))
+
+        if aggregations:
+            batches = self._apply_steps(
+                [aggregation.compile(self.column_index)
+                 for aggregation in aggregations], batches, aggregation_stats)
+
+        if self.row_output:
+            print "Processing rows and writing table {0}".format(table)
+            self._write_table(sinks, sink_stats, table, self.outputs,
+                              (map(final_selector, batch) for batch in batches),
+                              ('event_time',) + between
+                              if between is not None else None,
+                              replace)
+        else:
+            print "Processing rows of table {0}".format(table)
+            for batch in batches:
+                pass
+        for aggregation in aggregations if between is None else []:
+            name = '{0}_{1}'.format(table, aggregation.name)
+            print "Writing table {0}".format(name)
+            self._write_table(sinks, sink_stats, name,
+                              aggregation.outputs(dict(self.outputs)),
+                              chunked(aggregation.rows(), self.chunk_size))
+
+        for processor, hits, misses, size in self.cache_stats():
+            print "{0}: {1} cache hits, {2} misses, {3} cached".format(
+                type(processor).__name__, hits, misses, size)
+        for step, hits, kind, pattern in self.rejection_stats():
+            print "{0}: {1} rows rejected by {2} {3!r}".format(
+                self._step_name(step), hits, kind, pattern)
+        if self.profile_dir:
+            self._write_profile(profile, processor_stats.values())
+
+        return mark[0], aggregations if between is not None else []
+
+    def _try_reduce_table(self, source, sinks, table, between = None,
+                          replace = False):
+        """
+        Like _reduce_table(), but return a pair of (None, what
+        _reduce_table() returns) on success, or (the traceback as a
+        string, None) if reducing @table failed
+        """
+        try:
+            return None, self._reduce_table(source, sinks, table, between,
+                                            replace)
+        except Exception:
+            # a half-read streaming source can not be reused
+            source.close()
+            return traceback.format_exc(), None
+
+    def _table_done(self, table, error, high_water, results):
+        """
+        Record the outcome of reducing @table in @results, and its new
+        high-water mark in the saved state
+        """
+        results[table] = error
+        if not error and self.state_file:
+            if high_water is not None:
+                self.high_water[table] = high_water
+            self._save_state()
+
+    def _unit_done(self, table, between, error, result, results):
+        """
+        Record the outcome of reducing @table, or its range @between,
+        in @results, and in the saved state or the checkpoint. @result
+        is what _reduce_table() returned, if it succeeded.
+        """
+        if between is None:
+            self._table_done(table, error, result and result[0], results)
+            return
+        if error:
+            results[table] = error
+            return
+        entry = self.checkpoint[table]
+        entry['done'].add(between)
+        if entry['aggregations'] is None:
+            entry['aggregations'] = result[1]
+        else:
+            for aggregation, partial in zip(entry['aggregations'], result[1]):
+                aggregation.merge(partial)
+        if self.workers == 1:
+            entry['processors'] = self._processor_states()
+        self._save_checkpoint()
+
+    def _range_started(self, table, between):
+        """
+        Record in the checkpoint that the range @between of @table is
+        being reduced, so that a later run replaces whatever rows of it
+        this one loads
+        """
+        entry = self.checkpoint[table]
+        if between not in entry['started']:
+            entry['started'].add(between)
+            self._save_checkpoint()
+
+    def _resume_ranges(self, table):
+        """
+        Before reducing the remaining ranges of @table in order, restore
+        the Processor states saved with the ranges already done
+        """
+        entry = self.checkpoint[table]
+        if not entry['done']:
+            return
+        if entry['processors'] is not None:
+            self._restore_processor_states(entry['processors'],
+                                           self.checkpoint_file)
+        elif not all(processor.stateless for processor in self.processors):
+            print >>sys.stderr, "No Processor state saved with the ranges " \
+                "of {0} done; the rest start without it".format(table)
+
+    def _dispatch(self, pool, unit):
+        """
+        Start reducing @unit in a worker of @pool, returning @unit and
+        the AsyncResult
+        """
+        table, between, replace = unit
+        if between is not None:
+            self._range_started(table, between)
+        return unit, pool.apply_async(_reduce_unit_worker, (unit,))
+
+    def _finish_table(self, sinks, table, results):
+        """
+        Once every range of @table is done, write the merged rollups of
+        its ranges, replacing any written before, and forget its
+        checkpoint
+        """
+        entry = self.checkpoint[table]
+        if entry['done'] != set(time_ranges(table, self.range_hours)):
+            return
+        sink_stats = [StepStats('sink', self._step_name(sink)) for sink in sinks]
+        try:
+            for aggregation in entry['aggregations'] or []:
+                name = '{0}_{1}'.format(table, aggregation.name)
+                print "Writing table {0}".format(name)
+                self._write_table(sinks, sink_stats, name,
+                                  aggregation.outputs(dict(self.outputs)),
+                                  chunked(aggregation.rows(), self.chunk_size),
+                                  (None, None, None), True)
+        except Exception:
+            results[table] = traceback.format_exc()
+            return
+        del self.checkpoint[table]
+        self._save_checkpoint()
+
+    def explain(self):
+        """
+        Print the plan of this Job: the general_log columns it reads,
+        its Prefilters, the order its Processors run in (see _plan()),
+        how they are grouped into sorts and steps, and what is written
+        """
+        print "Read columns: {0}".format(', '.join(self.raw_columns))
+        for fil in self.prefilters:
+            sql = ''
+            if getattr(fil, 'sql_where', None):
+                sql = ' (in SQL)' if getattr(fil, 'sql_complete', False) \
+                    else ' (partly in SQL)'
+            print "Prefilter {0}{1}".format(self._step_name(fil), sql)
+
+        pooled = self.workers == 1 and self.group_workers > 1
+        sort_schema, sql_sort_by = self._sort_schema()
+        if sql_sort_by:
+            print "Order by {0} in SQL".format(sql_sort_by)
+        for group in sort_schema:
+            head = group[0]
+            if head.sort_column:
+                line = "Sort by {0}{1}".format(
+                    head.sort_column, ' descending' if head.sort_reverse else '')
+                if self._shardable(group):
+                    print line + ", in {0} shards by {1}:".format(
+                        self.group_workers, head.partition_key)
+                    for processor in group:
+                        print "    Processor {0}".format(
+                            self._step_name(processor))
+                    continue
+                print line
+            else:
+                print "In {0} order".format('SQL' if sql_sort_by else 'table')
+            for start, stop, parallel in self._runs(group, pooled):
+                for first, last in self._units(start, stop):
+                    processors = self.pipeline[first:last]
+                    how = []
+                    if len(processors) > 1:
+                        how.append('fused')
+                    elif _takes_batches(processors[0]):
+                        how.append('batch')
+                    if parallel:
+                        how.append('row pool')
+                    print "    Processor{0} {1}{2}".format(
+                        's' if len(processors) > 1 else '',
+                        ' + '.join(self._step_name(processor)
+                                   for processor in processors),
+                        ' ({0})'.format(', '.join(how)) if how else '')
+        for note in self.plan_notes:
+            print "Plan: {0}".format(note)
+
+        if self.row_output:
+            print "Write rows: {0}".format(
+                ', '.join(col for col, typ in self.outputs))
+        for aggregation in self.aggregations:
+            print "Write rollup <table>_{0}: {1}".format(
+                aggregation.name, ', '.join(
+                    col for col, typ in aggregation.outputs()))
+
+    def run(self, target_db = None, source_db = 'general_log', source = None,
+            sinks = []):
+        """
+        Reduce each table of @source_db that has not been reduced yet
+        into @target_db. Rows are read from @source instead, if it is
+        given (see Sources.py), and are written to each of @sinks as
+        well as to @target_db (see Sinks.py). If @target_db is None,
+        they are only written to @sinks.
+
+        Returns a dict from table name to None if that table was
+        reduced successfully, or the traceback of the error if not. A
+        failed table does not stop the rest from being reduced.
+        """
+        if source is None:
+            source = MySQLSource(source_db, self.source_connections,
+                                 stream = self.stream,
+                                 batch_size = self.batch_size)
+        if not source.supports_sql and (self.selectors or
+                                        self._sort_schema()[1]):
+            print >>sys.stderr, "{0} can not apply selectors or " \
+                "sql_sort_by; ignoring them".format(type(source).__name__)
+        if target_db is not None:
+            sinks = [MySQLSink(target_db, self.target_connections,
+                               loader = self.loader,
+                               load_chunk_size = self.load_chunk_size,
+                               temp_dir = self.temp_dir)] + list(sinks)
+
+        self._load_state()
+        self._load_checkpoint()
+        tables = sorted(self._tables_to_reduce(source, sinks))
+        results = dict((table, None) for table in tables)
+
+        # what the workers take on: (table, range, replace) units
+        units = []
+        for table in tables:
+            if not self.range_hours:
+                units.append((table, None, False))
+                continue
+            ranges = time_ranges(table, self.range_hours)
+            entry = self.checkpoint.get(table)
+            if entry is None or entry.get('range_hours') != self.range_hours:
+                if entry is not None:
+                    print >>sys.stderr, "{0} was checkpointed with other " \
+                        "range_hours; reducing all of it again".format(table)
+                    # the rows loaded before are split at other times, so
+                    # start the table afresh
                     try:
-                        for processor in group:
-                            row.update(zip(processor.outputs,
-                                           processor.process(row)))
-                        newrows.append(row)
-                    except SkipRowException:
+                        for sink in sinks:
+                            sink.drop(table)
+                    except Exception:
+                        results[table] = traceback.format_exc()
                         continue
-                print "Done with one group of processors"
-                rows = newrows
-
-            print "All done processing, writing temp file and loading into table"
-            temp_filename = '{0}.tmp'.format(table)
-            with open(temp_filename, 'w') as outfile:
-                print >>outfile, '\n'.join('\t'.join(str(x) for x in
-                                                     final_selector(row))
-                                           for row in rows)
-
-            cur.execute("USE {0}".format(target_db))
-            cur.execute("CREATE TABLE {0} (".format(table) + \
-                        ',\n'.join("{0} {1}".format(col, typ)
-                                   for col, typ in self.outputs) + \
-                        ")")
-            cur.execute("LOAD DATA LOCAL INFILE '{0}' INTO TABLE {1}"
-                        .format(temp_filename, table))
-            
-            os.remove(temp_filename)
-
-        conn.commit()
-        cur.close()
-        conn.close()
+                entry = self.checkpoint[table] = {
+                    'range_hours': self.range_hours, 'done': set(),
+                    'started': set(), 'aggregations': None,
+                    'processors': None}
+            # only a range a previous run started can have rows loaded
+            units.extend((table, between, between in entry['started'])
+                         for between in ranges
+                         if between not in entry['done'])
+        self._save_checkpoint()
+        # connections must not be shared with forked workers
+        source.close()
+        for sink in sinks:
+            sink.close()
+
+        global _worker_job, _worker_source, _worker_sinks
+        if self.workers > 1:
+            _worker_job = self
+            _worker_source = source
+            _worker_sinks = sinks
+            pool = multiprocessing.Pool(self.workers)
+            try:
+                # a unit is only handed out when a worker is free, so a
+                # range is marked as started when it really is
+                units = iter(units)
+                running = [self._dispatch(pool, unit)
+                           for unit in islice(units, self.workers)]
+                while running:
+                    ready = [item for item in running if item[1].ready()]
+                    if not ready:
+                        running[0][1].wait(0.1)
+                        continue
+                    for item in ready:
+                        running.remove(item)
+                        (table, between, replace), async_result = item
+                        try:
+                            error, result = async_result.get()
+                        except Exception:
+                            error, result = traceback.format_exc(), None
+                        self._unit_done(table, between, error, result,
+                                        results)
+                        print "Finished {0}: {1}".format(
+                            self._unit_name(table, between),
+                            'FAILED' if error else 'ok')
+                        running.extend(self._dispatch(pool, unit)
+                                       for unit in islice(units, 1))
+            finally:
+                pool.close()
+                pool.join()
+                _worker_job = _worker_source = _worker_sinks = None
+        else:
+            if self.group_workers > 1:
+                _worker_job = self
+                self._row_pool = multiprocessing.Pool(self.group_workers)
+            try:
+                previous = None
+                for table, between, replace in units:
+                    if between is not None:
+                        # the Processor states saved with later ranges
+                        # would not fit a rerun of the failed one
+                        if results[table]:
+                            continue
+                        if table != previous:
+                            self._resume_ranges(table)
+                        self._range_started(table, between)
+                    previous = table
+                    error, result = self._try_reduce_table(source, sinks,
+                                                           table, between,
+                                                           replace)
+                    self._unit_done(table, between, error, result, results)
+            finally:
+                source.close()
+                for sink in sinks:
+                    sink.close()
+                if self._row_pool is not None:
+                    self._row_pool.close()
+                    self._row_pool.join()
+                    self._row_pool = None
+                    _worker_job = None
+
+        if self.range_hours:
+            try:
+                for table in tables:
+                    if not results[table]:
+                        self._finish_table(sinks, table, results)
+            finally:
+                for sink in sinks:
+                    sink.close()
+
+        failed = [table for table in tables if results[table]]
+        print "Reduced {0} of {1} tables".format(len(tables) - len(failed),
+                                                 len(tables))
+        for table in failed:
+            print >>sys.stderr, "Table {0} failed:\n{1}".format(table,
+                                                                results[table])
+        return results
+
+# Pool workers are forked from the process in Job.run(), and find the Job
+# here rather than having it pickled (Prefilters are usually lambdas).
+# Each table (or range) worker's copies of the Source and Sinks open
+# their own connections on first use; row pool workers need no
+# connections.
+_worker_job = None
+_worker_source = None
+_worker_sinks = None
+
+def _reduce_unit_worker(unit):
+    table, between, replace = unit
+    return _worker_job._try_reduce_table(_worker_source, _worker_sinks,
+                                         table, between, replace)
+
+def _process_chunk_worker(args):
+    start, stop, chunk = args
+    for batch in _worker_job._apply_steps(_worker_job._steps(start, stop),
+                                          [chunk]):
+        return batch
+    return []
+
+# Shard workers (see Job._process_sharded) are forked too, and are
+# passed the Job directly. Each reads batches of rows from @inbox until
+# None, and sends back ('rows', batch) messages, then ('state', [the
+# state of each Processor]) or ('error', traceback).
+def _shard_worker(job, start, stop, inbox, outbox):
+    received = [False]
+
+    def shards():
+        for shard in iter(inbox.get, None):
+            yield shard
+        received[0] = True
+
+    try:
+        processor = job.pipeline[start]
+        rows = external_sort(chain.from_iterable(shards()),
+                             key = itemgetter(job.column_index[
+                                 processor.sort_column]),
+                             reverse = processor.sort_reverse,
+                             buffer_size = max(1, job.sort_buffer_rows //
+                                               job.group_workers),
+                             temp_dir = job.temp_dir)
+        for batch in job._apply_steps(job._steps(start, stop),
+                                      chunked(rows, job.chunk_size)):
+            outbox.put(('rows', batch))
+        outbox.put(('state', [processor.get_state()
+                              for processor in job.pipeline[start:stop]]))
+    except Exception:
+        outbox.put(('error', traceback.format_exc()))
+        # the parent only reads the outbox once it has sent every row
+        if not received[0]:
+            for shard in iter(inbox.get, None):
+                pass
+
+def _put_shard(worker, inbox, shard, i):
+    """
+    Put @shard in the @inbox of shard @i's @worker, raising a
+    ShardException if the worker dies before taking it
+    """
+    while True:
+        try:
+            inbox.put(shard, timeout = 1)
+            return
+        except Queue.Full:
+            if not worker.is_alive():
+                raise ShardException("shard worker {0} exited with code "
+                                     "{1}".format(i, worker.exitcode))
+
+def _shard_rows(worker, outbox, states, i):
+    """
+    Generator over the rows sent back by shard @i's @worker through
+    @outbox, storing the states it finally sends in @states[@i]
+    """
+    while True:
+        try:
+            kind, value = outbox.get(timeout = 1)
+        except Queue.Empty:
+            if not worker.is_alive():
+                raise ShardException("shard worker {0} exited with code "
+                                     "{1}".format(i, worker.exitcode))
+            continue
+        if kind == 'rows':
+            for row in value:
+                yield row
+        elif kind == 'state':
+            states[i] = value
+            return
+        else:
+            raise ShardException(value)
@@ -0,0 +1,166 @@
+import os
+import time
+import fcntl
+import shutil
+import tempfile
+import threading
+
+def escape_field(value):
+    """
+    Format @value as a field of a LOAD DATA INFILE file with the default
+    FIELDS/LINES options: NULL as \\N, and backslash, tab, newline,
+    carriage return and NUL escaped with a backslash
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t') \
+                .replace('\n', '\\n').replace('\r', '\\r').replace('\0', '\\0')
+
+def quote_identifier(name):
+    """
+    Quote @name, a table or column name, with backquotes, so that it
+    may be a reserved word (such as database) or hold any character
+    """
+    return '`' + name.replace('`', '``') + '`'
+
+class FifoLoader(object):
+    """
+    Load rows into @table over @conn with LOAD DATA LOCAL INFILE, reading
+    from a named pipe in a new directory under @temp_dir. The LOAD DATA
+    runs in a background thread (MySQLdb releases the GIL while a query
+    runs), so rows are loaded by the server while later rows are still
+    being produced, and the output is never held in memory or on disk.
+
+    Call start(), then write() as many times as needed, then finish(),
+    or abort() if something went wrong.
+    """
+
+    def __init__(self, conn, table, temp_dir = None):
+        self.conn = conn
+        self.table = table
+        self.temp_dir = temp_dir
+        self.error = None
+
+    def _load(self):
+        cur = self.conn.cursor()
+        try:
+            cur.execute("LOAD DATA LOCAL INFILE %s INTO TABLE {0}"
+                        .format(quote_identifier(self.table)),
+                        (self.fifo_path,))
+        except Exception as e:
+            self.error = e
+        finally:
+            cur.close()
+
+    def start(self):
+        self.fifo_dir = tempfile.mkdtemp(dir = self.temp_dir)
+        self.fifo_path = os.path.join(self.fifo_dir, '{0}.fifo'.format(self.table))
+        os.mkfifo(self.fifo_path)
+        self.outfile = None
+        self.thread = threading.Thread(target = self._load)
+        self.thread.daemon = True
+        self.thread.start()
+
+        # Opening a pipe for writing blocks until it is opened for
+        # reading, which never happens if the LOAD DATA fails first, so
+        # poll without blocking instead
+        while True:
+            try:
+                fd = os.open(self.fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+                break
+            except OSError:
+                if not self.thread.is_alive():
+                    self._cleanup()
+                    raise self.error or IOError(
+                        "LOAD DATA did not read {0}".format(self.fifo_path))
+                time.sleep(0.01)
+        self.outfile = os.fdopen(fd, 'w', 1 << 16)
+        # back to blocking writes, so a full pipe just waits for the server
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+
+    def write(self, rows):
+        """
+        Write each of @rows (sequences of column values) to the pipe
+        """
+        write = self.outfile.write
+        try:
+            for row in rows:
+                write('\t'.join([escape_field(value) for value in row]))
+                write('\n')
+        except IOError:
+            # the server stopped reading the pipe; report why
+            self.thread.join()
+            if self.error is not None:
+                raise self.error
+            raise
+
+    def finish(self):
+        """
+        Close the pipe and wait for the LOAD DATA to complete
+        """
+        try:
+            self.outfile.close()
+            self.thread.join()
+        finally:
+            self._cleanup()
+        if self.error is not None:
+            raise self.error
+
+    def abort(self):
+        try:
+            if self.outfile is not None:
+                self.outfile.close()
+        except IOError:
+            pass
+        self.thread.join()
+        self._cleanup()
+
+    def _cleanup(self):
+        shutil.rmtree(self.fifo_dir, ignore_errors = True)
+
+class InsertLoader(object):
+    """
+    Load rows into @table over @conn with multi-row INSERT statements of
+    at most @chunk_size rows each. Values are escaped by the driver.
+    Slower than a FifoLoader, but works where LOAD DATA LOCAL is
+    disabled.
+
+    Call start(), then write() as many times as needed, then finish(),
+    or abort() if something went wrong.
+    """
+
+    def __init__(self, conn, table, columns, chunk_size = 1000):
+        self.conn = conn
+        self.table = table
+        self.columns = columns
+        self.chunk_size = chunk_size
+
+    def start(self):
+        self.cur = self.conn.cursor()
+        self.sql = "INSERT INTO {0} ({1}) VALUES ({2})".format(
+            quote_identifier(self.table),
+            ', '.join(quote_identifier(col) for col in self.columns),
+            ', '.join(['%s'] * len(self.columns)))
+        self.chunk = []
+
+    def write(self, rows):
+        chunk = self.chunk
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= self.chunk_size:
+                self.cur.executemany(self.sql, chunk)
+                del chunk[:]
+
+    def finish(self):
+        if self.chunk:
+            self.cur.executemany(self.sql, self.chunk)
+            del self.chunk[:]
+        self.cur.close()
+
+    def abort(self):
+        self.chunk = []
+        self.cur.close()
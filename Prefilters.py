@@ -1,5 +1,104 @@
 import re
 
+from myutils import RejectionEngine
+
+def like_escape(s):
+    """
+    Escape the LIKE wildcards (and the escape character, backslash) in
+    @s, so that it matches literally in a LIKE pattern
+    """
+    return s.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def rejection_sql(engine, column = 'argument'):
+    """
+    Translate the literal rules of the RejectionEngine @engine into a
+    SQL condition on @column which holds for the rows the engine does
+    not reject. Returns (clause, params, complete), where complete is
+    True if every rule was translated, so that the SQL alone is
+    equivalent to the engine; clause is None if no rule could be.
+    Regex rules, and case-insensitive rules with non-ASCII characters,
+    are not translated.
+    """
+    if engine.flags & ~re.I:
+        return None, [], False
+    if engine.ignore_case:
+        # LOWER() does nothing to binary strings, and general_log's
+        # argument is a blob in recent versions of MySQL
+        value = 'LOWER(CONVERT({0} USING utf8))'.format(column)
+        translatable = lambda s: all(ord(c) < 128 for c in s)
+    else:
+        value = column
+        translatable = lambda s: True
+
+    conditions = []
+    params = []
+    complete = not engine.start_regexes and not engine.term_regexes
+    for literals, pattern in ((engine.start_literals, '{0}%'),
+                              (engine.term_literals, '%{0}%')):
+        for literal in sorted(literals):
+            if translatable(literal):
+                conditions.append('{0} NOT LIKE BINARY %s'.format(value))
+                params.append(pattern.format(like_escape(literal)))
+            else:
+                complete = False
+    queries = [query for query in sorted(engine.queries) if translatable(query)]
+    if len(queries) < len(engine.queries):
+        complete = False
+    if queries:
+        conditions.append('BINARY {0} NOT IN ({1})'.format(
+            value, ', '.join(['%s'] * len(queries))))
+        params.extend(queries)
+
+    if not conditions:
+        return None, [], complete
+    # the engine reads NULL as ''
+    if engine.rule('') is None:
+        clause = '{0} IS NULL OR ({1})'
+    else:
+        clause = '{0} IS NOT NULL AND {1}'
+    return clause.format(column, ' AND '.join(conditions)), params, complete
+
+def rejection_prefilter(starts = [], terms = [], queries = [], flags = 0):
+    """
+    Return a prefilter that rejects queries that begin with one of
+    @starts, contain one of @terms, or are one of @queries, checking
+    all of them in a single pass (see myutils.RejectionEngine). Starts
+    and terms are regexes (or just search strings). The engine, with
+    its per-rule hit counts, is the prefilter's engine attribute.
+    Careful using starts and queries before cleaning queries.
+
+    The prefilter's sql_where attribute is a (clause, params) pair
+    which a Job reading from MySQL adds to its WHERE clause, so that
+    literal rules are applied by the server (rows it rejects are not
+    counted in the hit counts); it is None if no rule translates to
+    SQL. If sql_complete is True, the clause does everything the
+    prefilter does, and the Job does not run the prefilter itself.
+    """
+    engine = RejectionEngine(starts, terms, queries, flags)
+    rejects = engine.rejects
+    prefilter = lambda row: not rejects(row.get('argument'))
+    prefilter.__name__ = 'rejection_prefilter'
+    prefilter.columns = ['argument']
+    prefilter.engine = engine
+    clause, params, prefilter.sql_complete = rejection_sql(engine)
+    prefilter.sql_where = (clause, params) if clause else None
+    return prefilter
+
+def command_type_prefilter(command_types):
+    """
+    Return a prefilter that accepts only rows whose command_type is one
+    of @command_types ('Query', 'Execute', 'Connect', ...). Like a
+    selector, but it also works on sources that cannot apply SQL.
+    """
+    command_types = set(command_types)
+    prefilter = lambda row: row.get('command_type') in command_types
+    prefilter.__name__ = 'command_type_prefilter'
+    prefilter.columns = ['command_type']
+    prefilter.sql_where = ('command_type IN ({0})'.format(
+        ', '.join(['%s'] * len(command_types))), sorted(command_types))
+    prefilter.sql_complete = True
+    return prefilter
+
 def unwanted_starts_prefilter(unwanted_starts, flags=0):
     """
     Return a prefilter that rejects queries that begin with one of the
@@ -7,9 +106,7 @@ def unwanted_starts_prefilter(unwanted_starts, flags=0):
     strings).
     Careful using this before cleaning queries.
     """
-    unwanted_starts_re = re.compile('|'.join('{0}.*'.format(x) for x in unwanted_starts),
-                                    flags=flags)
-    return lambda row: not unwanted_starts_re.match(row.get('argument') or '')
+    return rejection_prefilter(starts = unwanted_starts, flags = flags)
 
 def unwanted_terms_prefilter(unwanted_terms, flags=0):
     """
@@ -17,13 +114,11 @@ def unwanted_terms_prefilter(unwanted_terms, flags=0):
     elements of @unwanted_terms, which are regexes (or just search
     strings)
     """
-    unwanted_terms_re = re.compile('|'.join(unwanted_terms), flags=flags)
-    return lambda row: not unwanted_terms_re.search(row.get('argument') or '')
+    return rejection_prefilter(terms = unwanted_terms, flags = flags)
 
 def ignore_queries_prefilter(queries):
     """
     Return a prefilter that rejects queries that are in @queries.
     Careful using this before cleaning queries.
     """
-    queries = set(queries)
-    return lambda row: not (row.get('argument') or '') in queries
+    return rejection_prefilter(queries = queries)
@@ -1,21 +1,110 @@
 import sys
 import re
+import datetime
+from itertools import izip
 
-from Exceptions import SkipRowException
+from Exceptions import SkipRowException, StatefulProcessorException
 
-from myutils import clean, get_reserved_words
+from myutils import SQLCleaner, default_cleaner, repl_constants, LRUCache, \
+    RejectionEngine, pattern, lazy_resource, lazy_getstate
 
 class BaseProcessor(object):
+    """
+    Subclasses set the inputs and outputs attributes and implement
+    process_values(), which is passed the values of the input columns
+    positionally (in the order of inputs) and returns a tuple of the
+    values of the output columns.
+
+    Processors written against the older interface may instead
+    override process(), which is passed the whole row; the row only
+    supports get() and [] lookups by column name.
+
+    Processors whose outputs depend only on the inputs of the same row
+    (no state kept between rows) should set stateless to True, which
+    allows the Job to run them on many rows in parallel. Processors
+    which never skip a row should set rejects to False, which lets the
+    Job leave them out when none of their outputs are used, and move
+    rejecting Processors ahead of them (see Job._plan).
+
+    Processors may also implement process_batch(), which is passed
+    whole input columns (lists of values, one per row of a batch) and
+    returns a list of output columns and a keep-mask: a list of
+    booleans, False for each row to skip, or None to keep every row.
+    The Job calls process_batch() instead of process_values() when a
+    Processor's own class implements it, which saves a Python call and
+    a SkipRowException per rejected row.
+
+    Sorted Processors (see sort_column) whose state is kept separately
+    for each value of one column, such as a session's thread_id, should
+    set partition_key to that column. The Job may then split the rows
+    by that column into shards which are sorted and processed in
+    parallel, each by its own copy of the Processor. get_state() of
+    such a Processor must return a dict keyed by values of the
+    partition_key column (or None), so that the states of the copies
+    can be merged back together.
+
+    Compiled patterns, keyword sets and the like should be lazy_resource
+    attributes (see myutils), taken from the shared resources of the
+    process: they are then only built when first used, and are not
+    copied when a Processor is pickled.
+    """
+
+    stateless = False
+
+    rejects = True
+
+    partition_key = None
+
+    __getstate__ = lazy_getstate
+
     def __init__(self):
         self.sort_column = None
         self.sql_sort_by = None
 
+    def process(self, row):
+        return self.process_values(*[row.get(col) for col in self.inputs])
+
+    def get_state(self):
+        """
+        Return the state this Processor carries from one row to the
+        next, in a picklable form, so that an incremental Job can resume
+        it later through set_state(). None means there is no state.
+        """
+        return None
+
+    def set_state(self, state):
+        pass
+
+    def process_values(self, *values):
+        raise NotImplementedError
+
+    def process_batch(self, *columns):
+        """
+        Run process_values() on each row of @columns, catching
+        SkipRowExceptions into the keep-mask
+        """
+        outputs = [[] for col in self.outputs]
+        keep = []
+        for values in izip(*columns):
+            try:
+                result = self.process_values(*values)
+            except SkipRowException:
+                keep.append(False)
+                result = [None] * len(outputs)
+            else:
+                keep.append(True)
+            for column, value in zip(outputs, result):
+                column.append(value)
+        return outputs, keep
+
 class UserHostIpProcessor(BaseProcessor):
     """
     Create 'user', 'host', and 'ip' columns by parsing the 'user_host'
     column. Reject rows with certain users, hosts, or ip's.
     """
 
+    stateless = True
+
     def __init__(self, users_reject = [], hosts_reject = [], ip_reject = []):
         super(UserHostIpProcessor, self).__init__()
         self.users_reject = set(users_reject)
@@ -25,111 +114,150 @@ class UserHostIpProcessor(BaseProcessor):
         self.inputs = ['user_host']
         self.outputs = ['user', 'host', 'ip']
 
-        self.user_host_re = re.compile(r".*\[(?P<uname>.*)\] @ (?P<host>.*) \[(?P<ip>.*)\]")
+    @lazy_resource
+    def user_host_re(self):
+        return pattern(r".*\[(?P<uname>.*)\] @ (?P<host>.*) \[(?P<ip>.*)\]")
 
-    def process(self, row):
-        m = self.user_host_re.match(row.get('user_host') or '')
+    def process_values(self, user_host):
+        m = self.user_host_re.match(user_host or '')
         if not m:
-            print >>sys.stderr, "Could not parse user_host: %s" % row.get('user_host')
-        
+            print >>sys.stderr, "Could not parse user_host: %s" % user_host
+            return None, None, None
+
         user, host, ip = m.group('uname', 'host', 'ip')
         if user in self.users_reject or host in self.hosts_reject or ip in self.ip_reject:
             raise SkipRowException
 
         return user, host, ip
 
+    def process_batch(self, user_hosts):
+        match = self.user_host_re.match
+        users_reject = self.users_reject
+        hosts_reject = self.hosts_reject
+        ip_reject = self.ip_reject
+        users, hosts, ips, keep = [], [], [], []
+        for user_host in user_hosts:
+            m = match(user_host or '')
+            if m:
+                user, host, ip = m.group('uname', 'host', 'ip')
+                keep.append(not (user in users_reject or host in hosts_reject
+                                 or ip in ip_reject))
+            else:
+                print >>sys.stderr, "Could not parse user_host: %s" % user_host
+                user = host = ip = None
+                keep.append(True)
+            users.append(user)
+            hosts.append(host)
+            ips.append(ip)
+        return [users, hosts, ips], keep
+
 class CleanProcessor(BaseProcessor):
     """
     Capitalize all sql keywords and replace all runs of whitespace
     with a single whitespace character.
     """
 
-    def __init__(self):
+    stateless = True
+
+    rejects = False
+
+    def __init__(self, reserved_words = None):
         super(CleanProcessor, self).__init__()
         self.inputs = ['argument']
         self.outputs = ['query']
-        self.reserved_words = get_reserved_words('mysql_keywords.txt')
+        self.reserved_words = reserved_words
 
-    def process(self, row):
-        return clean(row.get('argument') or '', reserved_words = self.reserved_words),
+    @lazy_resource
+    def cleaner(self):
+        if self.reserved_words:
+            return SQLCleaner(self.reserved_words)
+        return default_cleaner()
 
-class UnwantedTermsProcessor(BaseProcessor):
+    def process_values(self, argument):
+        return self.cleaner(argument or ''),
+
+class RejectQueriesProcessor(BaseProcessor):
     """
-    Reject queries that contain one of several unwanted terms
+    Reject queries that start with one of @starts, contain one of
+    @terms, or are one of @queries, checking all of them in a single
+    pass over each query (see myutils.RejectionEngine). Starts and
+    terms are regexes (or just search strings). Per-rule hit counts
+    are kept in self.engine.
     """
 
-    def __init__(self, unwanted_terms, flags=0):
-        super(UnwantedTermsProcessor, self).__init__()
-        self.unwanted_terms_re = re.compile('|'.join(unwanted_terms), flags=flags)
-        
+    stateless = True
+
+    def __init__(self, starts = [], terms = [], queries = [], flags = 0):
+        super(RejectQueriesProcessor, self).__init__()
+        self.engine = RejectionEngine(starts, terms, queries, flags)
+
         self.inputs = ['query']
         self.outputs = []
 
-    def process(self, row):
-        if self.unwanted_terms_re.search(row.get('query')):
+    def process_values(self, query):
+        if self.engine.rejects(query):
             raise SkipRowException
         return tuple()
 
-class UnwantedStartsProcessor(BaseProcessor):
+    def process_batch(self, queries):
+        return [], self.engine.keep_mask(queries)
+
+class UnwantedTermsProcessor(RejectQueriesProcessor):
+    """
+    Reject queries that contain one of several unwanted terms
+    """
+
+    def __init__(self, unwanted_terms, flags=0):
+        super(UnwantedTermsProcessor, self).__init__(terms = unwanted_terms,
+                                                     flags = flags)
+
+class UnwantedStartsProcessor(RejectQueriesProcessor):
     """
     Reject queries that start with one of several unwanted starts
     """
 
     def __init__(self, unwanted_starts, flags=0):
-        super(UnwantedStartsProcessor, self).__init__()
-        self.unwanted_starts_re = re.compile('|'.join('{0}.*'.format(x) for x in unwanted_starts),
-                                             flags=flags)
-        
-        self.inputs = ['query']
-        self.outputs = []
+        super(UnwantedStartsProcessor, self).__init__(starts = unwanted_starts,
+                                                      flags = flags)
 
-    def process(self, row):
-        if self.unwanted_starts_re.match(row.get('query')):
-            raise SkipRowException
-        return tuple()
-
-class IgnoreQueriesProcessor(BaseProcessor):
+class IgnoreQueriesProcessor(RejectQueriesProcessor):
     """
     Reject some specific queries
     """
 
     def __init__(self, ignore_queries):
-        super(IgnoreQueriesProcessor, self).__init__()
-        self.ignore_queries = set(ignore_queries)
-
-        self.inputs = ['query']
-        self.outputs = []
-
-    def process(self, row):
-        if row.get('query') in self.ignore_queries:
-            raise SkipRowException
-        return tuple()
+        super(IgnoreQueriesProcessor, self).__init__(queries = ignore_queries)
 
 class SimpleQueryTypeProcessor(BaseProcessor):
     """
     Add a column of the type of each query
     """
 
+    stateless = True
+
+    rejects = False
+
     def __init__(self):
         super(SimpleQueryTypeProcessor, self).__init__()
         self.inputs = ['query']
         self.outputs = ['query_type']
 
-    def process(self, row):
-        query = row.get('query')
-        if query.startswith('INSERT INTO'):
-            return "INSERT",
-        if query.startswith("SELECT"):
-            return "SELECT",
-        if query.startswith("CREATE TABLE"):
-            return "CREATE_TABLE",
-        if query.startswith("SET"):
-            return "SET",
-        if query.startswith("LOAD DATA"):
-            return "LOAD",
-        if query.startswith("ALTER"):
-            return "ALTER",
-        return "OTHER",
+    @lazy_resource
+    def query_type_re(self):
+        # Each group is named after the type of the queries it starts;
+        # alternatives are tried in order
+        return pattern(r'(?P<INSERT>INSERT INTO)|(?P<SELECT>SELECT)'
+                       r'|(?P<CREATE_TABLE>CREATE TABLE)|(?P<SET>SET)'
+                       r'|(?P<LOAD>LOAD DATA)|(?P<ALTER>ALTER)')
+
+    def process_values(self, query):
+        m = self.query_type_re.match(query)
+        return m.lastgroup if m else "OTHER",
+
+    def process_batch(self, queries):
+        match = self.query_type_re.match
+        matches = [match(query) for query in queries]
+        return [[m.lastgroup if m else "OTHER" for m in matches]], None
 
 class RegexReplaceProcessor(BaseProcessor):
     """
@@ -146,8 +274,8 @@ class RegexReplaceProcessor(BaseProcessor):
         self.inputs = [field]
         self.outputs = [field]
 
-    def process(self, row):
-        return self.regex.sub(self.sub_fcn, row.get(self.field)),
+    def process_values(self, value):
+        return self.regex.sub(self.sub_fcn, value),
 
 class TypeRegexReplaceProcessor(RegexReplaceProcessor):
     """
@@ -163,55 +291,263 @@ class TypeRegexReplaceProcessor(RegexReplaceProcessor):
 
         self.inputs.append('query_type')
 
-    def process(self, row):
-        if row.get('query_type') in self.query_types:
-            return super(TypeRegexReplaceProcessor, self).process(row)
-        return row.get(self.field)
+    def process_values(self, value, query_type):
+        if query_type in self.query_types:
+            return super(TypeRegexReplaceProcessor, self).process_values(value)
+        return value,
 
 class RemoveInsertValuesProcessor(BaseProcessor):
     """
     Remove the values from INSERT statements, replace with '<values>'
     """
 
+    stateless = True
+
+    rejects = False
+
     def __init__(self):
         super(RemoveInsertValuesProcessor, self).__init__()
         
         self.inputs = ['query_type', 'query']
         self.outputs = ['query']
 
+    @lazy_resource
+    def insert_re(self):
         # TODO: make this regex accept dots in table names
-        self.insert_re = re.compile(r"(INSERT INTO ['`]?\w+['`]?)")
-        self.values_re = re.compile(r'VALUES', re.I)
+        return pattern(r"(INSERT INTO ['`]?\w+['`]?)")
 
-    def process(self, row):
-        if row.get('query_type') == 'INSERT' and self.values_re.search(row.get('query')):
-            return (self.insert_re.match(row.get('query')).group(0) + ' <values>'),
-        return row.get('query'),
+    @lazy_resource
+    def values_re(self):
+        return pattern(r'VALUES', re.I)
+
+    def process_values(self, query_type, query):
+        if query_type == 'INSERT' and self.values_re.search(query):
+            return (self.insert_re.match(query).group(0) + ' <values>'),
+        return query,
 
 class ReplaceConstantsProcessor(BaseProcessor):
     """
-    Replace numerical constants with @replchar and concatenates the
+    Replace constants (numbers compared against, hex literals and quoted
+    strings; see myutils.const_re) with @replchar and concatenate the
     values, separated by @sepchar, into the 'vals' column.
     """
 
+    stateless = True
+
+    rejects = False
+
     def __init__(self, replchar = '?', sepchar = ' ~ '):
         super(ReplaceConstantsProcessor, self).__init__()
 
         self.replchar = replchar
         self.sepchar = sepchar
 
-        self.const_re = re.compile(r'[<>=]+ *([-0-9.e]+)')
-
         self.inputs = ['query']
         self.outputs = ['query', 'vals']
 
-    def process(self, row):
-        vals = []
-        query = row.get('query')
-        for m in self.const_re.finditer(query):
-            vals.append(m.group(1))
-            query = query.replace(m.group(),
-                                  m.group().replace(m.group(1),
-                                                    self.replchar))
-            
+    def process_values(self, query):
+        query, vals = repl_constants(query, self.replchar)
         return query, self.sepchar.join(vals)
+
+class MemoizedProcessor(BaseProcessor):
+    """
+    Run a chain of stateless Processors as one Processor, caching the
+    combined outputs (or the rejection of the row) for the most
+    recently seen @maxsize distinct inputs. Exact repeats of a query
+    then cost one cache lookup instead of a pass through every
+    Processor in the chain.
+
+    The cache is keyed on the values of the chain's input columns, or
+    on @fingerprint(*values) if @fingerprint is given. A fingerprint
+    must only give two inputs the same key if the chain produces the
+    same outputs for both.
+    """
+
+    stateless = True
+
+    _skip = object()
+
+    def __init__(self, processors, maxsize = 100000, fingerprint = None):
+        super(MemoizedProcessor, self).__init__()
+
+        for processor in processors:
+            if not getattr(processor, 'stateless', False):
+                raise StatefulProcessorException(processor)
+
+        self.processors = processors
+        self.rejects = any(getattr(processor, 'rejects', True)
+                           for processor in processors)
+        self.fingerprint = fingerprint
+        self.cache = LRUCache(maxsize)
+
+        self.inputs = []
+        self.outputs = []
+        for processor in processors:
+            self.inputs.extend(col for col in processor.inputs
+                               if col not in self.inputs
+                               and col not in self.outputs)
+            self.outputs.extend(col for col in processor.outputs
+                                if col not in self.outputs)
+
+    def process_values(self, *values):
+        key = self.fingerprint(*values) if self.fingerprint else values
+        result = self.cache.get(key)
+        if result is None:
+            row = dict(zip(self.inputs, values))
+            try:
+                for processor in self.processors:
+                    row.update(zip(processor.outputs, processor.process(row)))
+            except SkipRowException:
+                result = self._skip
+            else:
+                result = tuple(row[col] for col in self.outputs)
+            self.cache.put(key, result)
+
+        if result is self._skip:
+            raise SkipRowException
+        return result
+
+class LatencySession(object):
+    """
+    What a LatencyProcessor keeps about one session
+    """
+    __slots__ = ('last_time',)
+
+    def __init__(self, last_time = None):
+        self.last_time = last_time
+
+class DatabaseSession(object):
+    """
+    What a SessionDatabaseProcessor keeps about one session
+    """
+    __slots__ = ('last_time', 'database')
+
+    def __init__(self, last_time = None, database = None):
+        self.last_time = last_time
+        self.database = database
+
+class SessionProcessor(BaseProcessor):
+    """
+    Base class for Processors that follow each client session (by
+    thread_id) through the log, in event_time order. Subclasses set
+    the record attribute to a class with __slots__ (whose first slot
+    is last_time) for the record kept per session, and implement
+    step(), which is passed a session's record, the event_time and
+    command_type of a row and the values of any further inputs, and
+    returns the row's outputs.
+
+    A session starts afresh on a 'Connect' entry, or when nothing was
+    seen from it for @timeout seconds (by default MySQL's
+    wait_timeout), and is forgotten on 'Quit'. Idle sessions are swept
+    out once per @timeout of log time, so the state stays as small as
+    the number of open sessions. The state is a dict from thread_id to
+    a tuple of the record's slots.
+    """
+
+    record = None
+
+    partition_key = 'thread_id'
+
+    rejects = False
+
+    def __init__(self, timeout = 28800):
+        super(SessionProcessor, self).__init__()
+
+        self.sort_column = 'event_time'
+        self.sort_reverse = False
+        self.timeout = datetime.timedelta(seconds = timeout)
+        self.sessions = {}
+        self.next_sweep = None
+
+        self.inputs = ['event_time', 'thread_id', 'command_type']
+
+    def _sweep(self, now):
+        cutoff = now - self.timeout
+        for thread_id in [thread_id for thread_id, session
+                          in self.sessions.iteritems()
+                          if session.last_time < cutoff]:
+            del self.sessions[thread_id]
+        self.next_sweep = now + self.timeout
+
+    def step(self, session, event_time, command_type, *values):
+        raise NotImplementedError
+
+    def process_values(self, event_time, thread_id, command_type, *values):
+        if self.next_sweep is None or event_time >= self.next_sweep:
+            self._sweep(event_time)
+
+        session = self.sessions.get(thread_id)
+        if session is None or command_type == 'Connect' or \
+           event_time - session.last_time > self.timeout:
+            session = self.sessions[thread_id] = self.record()
+
+        result = self.step(session, event_time, command_type, *values)
+        session.last_time = event_time
+        if command_type == 'Quit':
+            del self.sessions[thread_id]
+        return result
+
+    def get_state(self):
+        slots = self.record.__slots__
+        return dict((thread_id, tuple(getattr(session, slot) for slot in slots))
+                    for thread_id, session in self.sessions.iteritems())
+
+    def set_state(self, state):
+        self.sessions = dict((thread_id, self.record(*values))
+                             for thread_id, values in state.iteritems())
+        self.next_sweep = None
+
+class LatencyProcessor(SessionProcessor):
+    """
+    Create a 'latency' column: the seconds elapsed since the previous
+    entry of the same session, a naive estimate of how long the
+    previous statement took (plus the client's think time). None for
+    the first entry seen of a session.
+    """
+
+    record = LatencySession
+
+    def __init__(self, timeout = 28800):
+        super(LatencyProcessor, self).__init__(timeout)
+
+        self.outputs = ['latency']
+
+    def step(self, session, event_time, command_type):
+        if session.last_time is None:
+            return None,
+        return (event_time - session.last_time).total_seconds(),
+
+class SessionDatabaseProcessor(SessionProcessor):
+    """
+    Create a 'database' column: the default database of the session
+    when each entry ran, as set by the database named on 'Connect',
+    'Init DB' entries and USE statements. None until it is known.
+    """
+
+    record = DatabaseSession
+
+    def __init__(self, timeout = 28800):
+        super(SessionDatabaseProcessor, self).__init__(timeout)
+
+        self.inputs.append('argument')
+        self.outputs = ['database']
+
+    @lazy_resource
+    def connect_re(self):
+        return pattern(r'.* on (\S+)')
+
+    @lazy_resource
+    def use_re(self):
+        return pattern(r'\s*USE\s+`?([^`\s;]+)', re.I)
+
+    def step(self, session, event_time, command_type, argument):
+        if command_type == 'Connect':
+            m = self.connect_re.match(argument or '')
+            session.database = m.group(1) if m else None
+        elif command_type == 'Init DB':
+            session.database = (argument or '').strip() or session.database
+        elif command_type == 'Query':
+            m = self.use_re.match(argument or '')
+            if m:
+                session.database = m.group(1)
+        return session.database,
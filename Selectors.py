@@ -1,5 +1,14 @@
 def column_string_values_selector(column, values):
-    return "{0} IN ({1})".format(column, ', '.join("'{0}'".format(val) for val in values))
+    """
+    Return a selector, as a (sql, params) pair, for rows whose @column
+    is one of @values
+    """
+    return "{0} IN ({1})".format(column, ', '.join(['%s'] * len(values))), \
+           list(values)
 
 def column_string_value_selector(column, value):
-    return "{0} = {1}".format(column, value)
+    """
+    Return a selector, as a (sql, params) pair, for rows whose @column
+    is @value
+    """
+    return "{0} = %s".format(column), [value]
@@ -0,0 +1,311 @@
+import os
+import re
+import shutil
+
+from Loaders import FifoLoader, InsertLoader, quote_identifier
+from Connections import as_pool
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+class MySQLSink(object):
+    """
+    Load each reduced table into a table of the same name in database
+    @db, over a connection from @connections (a
+    Connections.ConnectionPool, or a callable opening new connections),
+    which is kept until close(). Rows are loaded
+    as they are written, by a FifoLoader, or by an InsertLoader of
+    @load_chunk_size rows if @loader is 'insert' (see Loaders.py).
+
+    A Sink has a tables() method returning the names of the tables it
+    already holds, and begin(), write(), commit() and abort() methods
+    which the Job calls, in that order, to output one table: begin()
+    is passed the table name, the Job's outputs (a list of (column,
+    sql type) pairs) and whether to append to an existing table, and
+    write() is passed lists of rows, as tuples of output values.
+
+    begin() may also be passed span, a (column, start, end) range,
+    when the rows written are those of the table with start <= column <
+    end (either bound may be None), or all of them if column is None,
+    and replace: if True, the rows already in the table in that span
+    are deleted first, so that writing the same range again does not
+    duplicate it. A Job passes span whenever it splits tables into
+    ranges (see Job.range_hours), and replace for a range a failed run
+    may have loaded. drop() removes a table altogether.
+    """
+
+    def __init__(self, db, connections, loader = 'fifo',
+                 load_chunk_size = 1000, temp_dir = None):
+        self.db = db
+        self.connections = as_pool(connections)
+        self.loader = loader
+        self.load_chunk_size = load_chunk_size
+        self.temp_dir = temp_dir
+        self.conn = None
+
+    def _conn(self):
+        # connect lazily, so that a Sink can be handed to forked workers
+        # which then get their own connections
+        if self.conn is None:
+            self.conn = self.connections.get()
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.connections.put(self.conn)
+            self.conn = None
+
+    def tables(self):
+        return sorted(self.connections.tables([self.db])[self.db])
+
+    def begin(self, table, outputs, append = False, span = None,
+              replace = False):
+        conn = self._conn()
+        self.table = table
+        self.append = append
+        cur = conn.cursor()
+        cur.execute("USE {0}".format(quote_identifier(self.db)))
+        cur.execute("CREATE TABLE {0}{1} (".format(
+                        'IF NOT EXISTS ' if append else '',
+                        quote_identifier(table)) + \
+                    ',\n'.join("{0} {1}".format(quote_identifier(col), typ)
+                               for col, typ in outputs) + \
+                    ")")
+        if span is not None and replace:
+            # in the same transaction as the load, so a failed load
+            # leaves the old rows in place
+            column, start, end = span
+            conditions = []
+            params = []
+            if column is not None and start is not None:
+                conditions.append("{0} >= %s".format(
+                    quote_identifier(column)))
+                params.append(start)
+            if column is not None and end is not None:
+                conditions.append("{0} < %s".format(
+                    quote_identifier(column)))
+                params.append(end)
+            cur.execute("DELETE FROM {0}".format(quote_identifier(table)) +
+                        (" WHERE " + " AND ".join(conditions)
+                         if conditions else ""), params or None)
+        cur.close()
+
+        if self.loader == 'insert':
+            self.current = InsertLoader(conn, table,
+                                        [col for col, typ in outputs],
+                                        chunk_size = self.load_chunk_size)
+        else:
+            self.current = FifoLoader(conn, table, temp_dir = self.temp_dir)
+        try:
+            self.current.start()
+        except Exception:
+            self.current = None
+            self.abort()
+            raise
+
+    def write(self, rows):
+        self.current.write(rows)
+
+    def commit(self):
+        self.current.finish()
+        self.current = None
+        self.conn.commit()
+
+    def abort(self):
+        if self.current is not None:
+            self.current.abort()
+            self.current = None
+        try:
+            self.conn.rollback()
+            # a table that was never filled in would be skipped by later
+            # runs
+            if not self.append:
+                cur = self.conn.cursor()
+                cur.execute("DROP TABLE IF EXISTS {0}".format(
+                    quote_identifier(self.table)))
+                cur.close()
+        except Exception:
+            # the connection may be what failed; start afresh next time
+            self.close()
+
+    def drop(self, table):
+        conn = self._conn()
+        cur = conn.cursor()
+        cur.execute("USE {0}".format(quote_identifier(self.db)))
+        cur.execute("DROP TABLE IF EXISTS {0}".format(quote_identifier(table)))
+        cur.close()
+        conn.commit()
+
+class NullSink(object):
+    """
+    Throw the rows away, only counting them (in self.rows, by table).
+    Useful for measuring a Job without the cost of any output.
+    """
+
+    def __init__(self):
+        self.rows = {}
+
+    def close(self):
+        pass
+
+    def tables(self):
+        return []
+
+    def begin(self, table, outputs, append = False, span = None,
+              replace = False):
+        self.table = table
+        self.count = 0
+
+    def write(self, rows):
+        self.count += len(rows)
+
+    def commit(self):
+        self.rows[self.table] = self.rows.get(self.table, 0) + self.count
+
+    def abort(self):
+        pass
+
+    def drop(self, table):
+        self.rows.pop(table, None)
+
+def arrow_type(sqltype):
+    """
+    Return the Arrow type to store a column of SQL type @sqltype as
+    """
+    base = re.match(r'\s*(\w+)', sqltype).group(1).upper()
+    if base in ('TIMESTAMP', 'DATETIME'):
+        return pa.timestamp('us')
+    if base == 'DATE':
+        return pa.date32()
+    if base in ('TINYINT', 'SMALLINT', 'MEDIUMINT', 'INT', 'INTEGER',
+                'BIGINT', 'BIT', 'BOOL', 'BOOLEAN', 'YEAR'):
+        return pa.int64()
+    if base in ('FLOAT', 'DOUBLE', 'REAL', 'DECIMAL', 'NUMERIC'):
+        return pa.float64()
+    if base in ('BINARY', 'VARBINARY', 'BLOB', 'TINYBLOB', 'MEDIUMBLOB',
+                'LONGBLOB'):
+        return pa.binary()
+    return pa.string()
+
+class ParquetSink(object):
+    """
+    Write each reduced table as a Parquet dataset: a directory
+    @directory/<table> of part files, one per run (incremental runs add
+    a part). Columns are typed from the SQL types of the Job's outputs
+    (see arrow_type()). @dictionary_columns, which should be the
+    columns with few distinct values, are dictionary-encoded; all
+    columns are compressed with @compression. Rows are written in row
+    groups of @row_group_size as they arrive, so a table never has to
+    fit in memory. A span (see MySQLSink) is written as its own file,
+    named after the span, which a rewrite of the span replaces.
+
+    Requires pyarrow.
+    """
+
+    def __init__(self, directory,
+                 dictionary_columns = ('query_type', 'user', 'host', 'query'),
+                 row_group_size = 100000, compression = 'snappy'):
+        if pa is None:
+            raise ImportError("ParquetSink requires pyarrow")
+        self.directory = directory
+        self.dictionary_columns = dictionary_columns
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.writer = None
+
+    def close(self):
+        pass
+
+    def tables(self):
+        """
+        The tables with at least one committed file; a directory left by
+        a failed write does not count, so the table is reduced again
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        return [name for name in os.listdir(self.directory)
+                if os.path.isdir(os.path.join(self.directory, name))
+                and any(self._committed(filename) for filename
+                        in os.listdir(os.path.join(self.directory, name)))]
+
+    def _committed(self, filename):
+        return filename.startswith(('part-', 'range-')) and \
+            filename.endswith('.parquet')
+
+    def begin(self, table, outputs, append = False, span = None,
+              replace = False):
+        table_dir = os.path.join(self.directory, table)
+        try:
+            os.makedirs(table_dir)
+        except OSError:
+            # another worker may have just made it
+            if not os.path.isdir(table_dir):
+                raise
+        if span is not None:
+            # a span always goes to the same file, which replaces any
+            # written before, so replace needs nothing more
+            column, start, end = span
+            self.path = os.path.join(table_dir, 'range-{0}.parquet'.format(
+                'all' if column is None else
+                start.strftime('%Y%m%d%H%M%S') if start is not None
+                else 'start'))
+        else:
+            part = len([name for name in os.listdir(table_dir)
+                        if name.startswith('part-')
+                        and name.endswith('.parquet')])
+            self.path = os.path.join(table_dir,
+                                     'part-{0:05d}.parquet'.format(part))
+
+        self.types = [arrow_type(typ) for col, typ in outputs]
+        self.encode = [col in self.dictionary_columns for col, typ in outputs]
+        self.schema = pa.schema([
+            pa.field(col, pa.dictionary(pa.int32(), arrow_typ)
+                     if encode else arrow_typ)
+            for (col, typ), arrow_typ, encode
+            in zip(outputs, self.types, self.encode)])
+        self.writer = pq.ParquetWriter(
+            self.path + '.tmp', self.schema, compression = self.compression,
+            use_dictionary = [col for col, typ in outputs
+                              if col in self.dictionary_columns])
+        self.buffer = []
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        arrays = []
+        for values, arrow_typ, encode in zip(zip(*self.buffer), self.types,
+                                             self.encode):
+            array = pa.array(list(values), type = arrow_typ)
+            arrays.append(array.dictionary_encode() if encode else array)
+        self.writer.write_table(pa.Table.from_arrays(arrays,
+                                                     schema = self.schema))
+        self.buffer = []
+
+    def write(self, rows):
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.row_group_size:
+            self._flush()
+
+    def commit(self):
+        self._flush()
+        self.writer.close()
+        self.writer = None
+        os.rename(self.path + '.tmp', self.path)
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if os.path.exists(self.path + '.tmp'):
+            os.remove(self.path + '.tmp')
+        try:
+            os.rmdir(os.path.dirname(self.path))
+        except OSError:
+            # it holds the files of earlier runs or of other workers
+            pass
+
+    def drop(self, table):
+        shutil.rmtree(os.path.join(self.directory, table), ignore_errors = True)
@@ -0,0 +1,335 @@
+import io
+import os
+import re
+import gzip
+import datetime
+
+from operator import itemgetter
+
+from myutils import print_and_execute
+from Connections import as_pool
+
+# columns of the raw general_log, in table order
+GENERAL_LOG_COLUMNS = ('event_time', 'user_host', 'thread_id', 'server_id',
+                       'command_type', 'argument')
+
+class MySQLSource(object):
+    """
+    The general_log tables in database @db, read over a connection from
+    @connections (a Connections.ConnectionPool, or a callable opening
+    new connections), which is kept until close(). If @stream is True, rows are read through an
+    unbuffered server-side cursor, @batch_size at a time, instead of the
+    whole table being fetched at once.
+
+    A Source has a tables() method returning the names of the tables it
+    can read, a rows() method returning an iterator over the rows of one
+    of them, and a close() method. supports_sql tells the Job whether
+    rows() can apply a WHERE clause and sort order.
+    """
+
+    supports_sql = True
+
+    def __init__(self, db, connections, stream = False, batch_size = 10000):
+        self.db = db
+        self.connections = as_pool(connections)
+        self.stream = stream
+        self.batch_size = batch_size
+        self.conn = None
+
+    def _conn(self):
+        # connect lazily, so that a Source can be handed to forked
+        # workers which then get their own connections
+        if self.conn is None:
+            self.conn = self.connections.get()
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.connections.put(self.conn)
+            self.conn = None
+
+    def tables(self):
+        return sorted(self.connections.tables([self.db])[self.db])
+
+    def rows(self, table, columns, where = '', params = (), order_by = '',
+             since = None, between = None):
+        """
+        Generator over the rows of @table, as tuples of the values of
+        @columns. @where is a WHERE clause (with %s placeholders for
+        @params) and @order_by an ORDER BY clause. If @since, a
+        datetime, is given, only rows with event_time >= @since are
+        selected, and if @between, a (start, end) pair of datetimes
+        (either of which may be None), only rows with start <=
+        event_time < end.
+        """
+        params = list(params)
+        conditions = []
+        if since is not None:
+            conditions.append("event_time >= %s")
+            params.append(since)
+        start, end = between or (None, None)
+        if start is not None:
+            conditions.append("event_time >= %s")
+            params.append(start)
+        if end is not None:
+            conditions.append("event_time < %s")
+            params.append(end)
+        if conditions:
+            if where:
+                where += " AND " + " AND ".join(conditions)
+            else:
+                where = "WHERE " + " AND ".join(conditions)
+        elif not params:
+            # nothing will be substituted, so %% escapes must be undone
+            where = where.replace('%%', '%')
+
+        conn = self._conn()
+        cur = conn.cursor()
+        cur.execute("USE {0}".format(self.db))
+        sql_full = "SELECT {0} FROM {1} {2} {3}".format(
+            ', '.join(columns), table, where, order_by)
+
+        if not self.stream:
+            print_and_execute(sql_full, cur, params)
+            rows = cur.fetchall()
+            cur.close()
+            for row in rows:
+                yield row
+            return
+
+        # unbuffered, so no other query may be run on conn until every
+        # row has been read from select_cur
+        from MySQLdb.cursors import SSCursor
+        select_cur = conn.cursor(SSCursor)
+        try:
+            print_and_execute(sql_full, select_cur, params)
+            while True:
+                batch = select_cur.fetchmany(self.batch_size)
+                if not batch:
+                    break
+                for row in batch:
+                    yield row
+        finally:
+            select_cur.close()
+            cur.close()
+
+def project(entries, columns, since = None, between = None):
+    """
+    Generator over @entries, tuples of the general_log columns (in
+    GENERAL_LOG_COLUMNS order), as tuples of the values of @columns,
+    skipping those with event_time before @since, if it is given, and
+    those whose event_time is outside @between, a (start, end) range,
+    if it is given
+    """
+    if tuple(columns) == GENERAL_LOG_COLUMNS:
+        select = None
+    else:
+        select = itemgetter(*[GENERAL_LOG_COLUMNS.index(col)
+                              for col in columns])
+        if len(columns) == 1:
+            single = select
+            select = lambda entry: (single(entry),)
+
+    start, end = between or (None, None)
+    for entry in entries:
+        if since is not None and entry[0] < since:
+            continue
+        if (start is not None and entry[0] < start) or \
+           (end is not None and entry[0] >= end):
+            continue
+        yield entry if select is None else select(entry)
+
+class MemorySource(object):
+    """
+    Rows held in memory, or generated on the fly: @tables is a dict
+    from table name to either a list of general_log tuples (in
+    GENERAL_LOG_COLUMNS order) or a function returning an iterator
+    over them. Useful for tests and benchmarks, with no MySQL server.
+    Like GeneralLogFileSource, it cannot apply Selectors or
+    sql_sort_by.
+    """
+
+    supports_sql = False
+
+    def __init__(self, tables):
+        self.data = tables
+
+    def close(self):
+        pass
+
+    def tables(self):
+        return self.data.keys()
+
+    def rows(self, table, columns, where = '', params = (), order_by = '',
+             since = None, between = None):
+        entries = self.data[table]
+        if callable(entries):
+            entries = entries()
+        return project(entries, columns, since, between)
+
+# A log entry starts with a timestamp, or with whitespace when it has the
+# same timestamp as the entry before, followed by the thread id, command
+# and (after a tab) the argument. mysqld < 5.6 writes timestamps like
+# '130314 10:45:01', later versions like '2013-03-14T10:45:01.123456Z'.
+log_entry_re = re.compile(r'(?:(?P<time>\d{6} [ \d]\d:\d\d:\d\d'
+                          r'|\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(?:\.\d+)?'
+                          r'(?:Z|[-+]\d\d:\d\d)?)\s+|\s+)'
+                          r'(?P<id>\d+) (?P<cmd>[A-Z][a-z]+(?: [A-Za-z]+)?)'
+                          r'(?:\t(?P<arg>.*))?$')
+
+# Lines mysqld writes whenever it (re)opens the log file
+log_header_re = re.compile(r'\S+, Version: .* started with:$'
+                           r'|Tcp port: \d+\s+Unix socket: '
+                           r'|Time\s+Id\s+Command\s+Argument$')
+
+# Argument of a Connect entry
+log_connect_re = re.compile(r'(?P<user>[^@\s]*)@(?P<host>\S*) on ')
+ip_re = re.compile(r'[0-9.:]+$')
+
+def parse_log_time(time_str):
+    """
+    Parse a general query log timestamp, in either the
+    '130314 10:45:01' or the '2013-03-14T10:45:01.123456Z' format
+    """
+    if time_str[6] == ' ':
+        return datetime.datetime(2000 + int(time_str[0:2]), int(time_str[2:4]),
+                                 int(time_str[4:6]), int(time_str[7:9]),
+                                 int(time_str[10:12]), int(time_str[13:15]))
+    micro = 0
+    if len(time_str) > 19 and time_str[19] == '.':
+        digits = re.match(r'\d+', time_str[20:]).group()
+        micro = int(digits[:6].ljust(6, '0'))
+    return datetime.datetime(int(time_str[0:4]), int(time_str[5:7]),
+                             int(time_str[8:10]), int(time_str[11:13]),
+                             int(time_str[14:16]), int(time_str[17:19]), micro)
+
+def log_user_host(connect_argument):
+    """
+    Build a user_host value, in the format of the general_log table,
+    from the argument of a Connect entry in a general query log file
+    ('abecker@darkstar.astro.washington.edu on sdss')
+    """
+    m = log_connect_re.match(connect_argument)
+    if not m:
+        return ''
+    user, host = m.group('user', 'host')
+    if ip_re.match(host):
+        return '{0}[{0}] @  [{1}]'.format(user, host)
+    return '{0}[{0}] @ {1} []'.format(user, host)
+
+class GeneralLogFileSource(object):
+    """
+    Rows from general query log files, as written by mysqld with
+    log_output=FILE, so that rotated logs (plain or gzipped) can be
+    processed without loading them into MySQL first. Each file in
+    @paths is one table, named @table_name(path); by default the file
+    name without a .gz extension, with non-word characters replaced by
+    underscores.
+
+    The log files have no user_host or server_id. user_host is rebuilt
+    from the Connect entry of each thread (threads connected before the
+    log starts get ''), and server_id is @server_id.
+
+    Files are read sequentially through @buffer_size byte buffers. Rows
+    come out in log order, which is event_time order, so Selectors and
+    sql_sort_by cannot be applied (supports_sql is False); use
+    Prefilters and sort_column instead.
+    """
+
+    supports_sql = False
+
+    def __init__(self, paths, server_id = 0, table_name = None,
+                 buffer_size = 1 << 20):
+        self.server_id = server_id
+        self.buffer_size = buffer_size
+        table_name = table_name or self.default_table_name
+        self.paths = dict((table_name(path), path) for path in paths)
+
+    @staticmethod
+    def default_table_name(path):
+        name = os.path.basename(path)
+        if name.endswith('.gz'):
+            name = name[:-3]
+        return re.sub(r'\W', '_', name)
+
+    def close(self):
+        pass
+
+    def tables(self):
+        return self.paths.keys()
+
+    def _open(self, path):
+        if path.endswith('.gz'):
+            return io.BufferedReader(gzip.open(path, 'rb'), self.buffer_size)
+        return io.open(path, 'rb', buffering = self.buffer_size)
+
+    def entries(self, path):
+        """
+        Generator over the entries of the log file at @path, as tuples of
+        the general_log columns (in GENERAL_LOG_COLUMNS order). Lines
+        which are not an entry or a header continue the argument of the
+        previous entry (multi-line queries).
+        """
+        entry_match = log_entry_re.match
+        header_match = log_header_re.match
+        server_id = self.server_id
+        user_hosts = {}
+        time_str = None
+        event_time = None
+        entry = None
+        # the lines of a multi-line argument, joined once it is complete
+        lines = None
+
+        with self._open(path) as infile:
+            for line in infile:
+                line = line.rstrip('\r\n')
+                m = entry_match(line)
+                if m is None:
+                    if header_match(line):
+                        continue
+                    if entry is not None:
+                        if lines is None:
+                            lines = [entry[5]]
+                        lines.append(line)
+                    continue
+
+                if entry is not None:
+                    if lines is not None:
+                        entry[5] = '\n'.join(lines)
+                        lines = None
+                    yield tuple(entry)
+
+                new_time, thread_id, command, argument = \
+                    m.group('time', 'id', 'cmd', 'arg')
+                if new_time is not None and new_time != time_str:
+                    time_str = new_time
+                    event_time = parse_log_time(new_time)
+                thread_id = int(thread_id)
+                argument = argument or ''
+
+                if command == 'Connect':
+                    user_hosts[thread_id] = log_user_host(argument)
+                user_host = user_hosts.get(thread_id, '')
+                if command == 'Quit':
+                    user_hosts.pop(thread_id, None)
+
+                entry = [event_time, user_host, thread_id, server_id,
+                         command, argument]
+
+            if entry is not None:
+                if lines is not None:
+                    entry[5] = '\n'.join(lines)
+                yield tuple(entry)
+
+    def rows(self, table, columns, where = '', params = (), order_by = '',
+             since = None, between = None):
+        """
+        Generator over the entries of @table, as tuples of the values of
+        @columns. @where, @params and @order_by are not supported and
+        are ignored. If @since, a datetime, is given, only entries with
+        event_time >= @since are returned, and if
+        @between, a (start, end) range, only those with event_time in
+        it (the whole file is still read).
+        """
+        return project(self.entries(self.paths[table]), columns, since,
+                       between)
@@ -0,0 +1,51 @@
+"""
+Compare the throughput of myutils.clean() against the implementation it
+replaced (a whitespace re.split() with two upper() calls per word).
+
+Run from the top of the repository:
+
+    python benchmarks/clean_bench.py [number of queries]
+"""
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from myutils import clean, keywords
+
+QUERIES = [
+    "select  *  from t where a=5 and b = 'hello world'",
+    "SHOW tables",
+    "insert into foo values (1,2, 'abc', 'def')",
+    "SELECT x, y, z FROM y\n  WHERE z > 3.5 and w = 7 ORDER BY x desc limit 10",
+    "commit",
+    "select count(*) from users u join orders o on u.id = o.user_id "
+    "where o.status in ('a','b','c') group by u.name",
+    "SET autocommit=0",
+    "update photo set ra = 12.5, decl = -3.25 where objid = 1237657 "
+    "and run in (3325, 3326, 3327, 3328, 3329, 3330)",
+]
+
+def legacy_clean(query, reserved_words):
+    return ' '.join([
+        (word.upper() if word.upper() in reserved_words else word)
+        for word in re.split('\s+', query)
+    ])
+
+def throughput(fcn, queries):
+    start = time.time()
+    for query in queries:
+        fcn(query)
+    return len(queries) / (time.time() - start)
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    reserved_words = keywords()
+    queries = [QUERIES[i % len(QUERIES)] for i in xrange(n)]
+
+    old = throughput(lambda q: legacy_clean(q, reserved_words), queries)
+    new = throughput(clean, queries)
+    print "legacy clean(): {0:12.0f} queries/sec".format(old)
+    print "clean():        {0:12.0f} queries/sec ({1:.2f}x)".format(new, new / old)
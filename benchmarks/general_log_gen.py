@@ -0,0 +1,193 @@
+"""
+Generate a synthetic general_log, deterministically from a seed, for
+benchmarks and tests that must run without a MySQL server.
+
+Each client thread connects, runs a burst of statements and quits, so
+the log has Connect/Init DB/Query/Quit entries with realistic
+user_host values. Statements are drawn from a fixed set of query
+shapes with varying constants (so many queries repeat a shape, and
+some repeat exactly), and include INSERTs with many rows, long IN
+lists, multi-line SELECTs, SET and LOAD DATA statements.
+
+Run from the top of the repository to write a log file in the format
+mysqld writes with log_output=FILE (see Sources.GeneralLogFileSource):
+
+    python benchmarks/general_log_gen.py <rows> <path> [seed]
+"""
+import datetime
+import random
+import sys
+
+USERS = [('sdss', 'portal.example.edu', '10.0.4.17'),
+         ('sdss', 'portal.example.edu', '10.0.4.18'),
+         ('casjobs', 'batch1.example.edu', '10.0.5.2'),
+         ('casjobs', 'batch2.example.edu', '10.0.5.3'),
+         ('webuser', '', '192.168.1.20'),
+         ('webuser', '', '192.168.1.21'),
+         ('analyst', 'desk7.example.org', '172.16.0.7'),
+         ('root', 'localhost', ''),
+         ('buildbot', 'ci.example.org', '10.0.9.1')]
+
+DATABASES = ['sdss', 'photo', 'spec', 'scratch']
+
+TABLES = ['photoobj', 'specobj', 'field', 'run', 'neighbors', 'users']
+
+COLUMNS = ['objid', 'ra', 'decl', 'run', 'camcol', 'field', 'mag_r',
+           'z', 'status', 'name']
+
+# (weight, shape) pairs; shapes are functions of a random.Random
+def _point_select(rng):
+    return "select {0}, {1} from {2} where objid = {3}".format(
+        rng.choice(COLUMNS), rng.choice(COLUMNS), rng.choice(TABLES),
+        rng.randint(1, 10 ** 12))
+
+def _range_select(rng):
+    return "SELECT * FROM {0} WHERE ra BETWEEN {1:.4f} AND {2:.4f} " \
+        "and decl > {3:.3f} LIMIT {4}".format(
+            rng.choice(TABLES), rng.uniform(0, 180), rng.uniform(180, 360),
+            rng.uniform(-90, 90), rng.choice([10, 100, 1000]))
+
+def _in_list_select(rng):
+    ids = ', '.join(str(rng.randint(1, 10 ** 6))
+                    for i in xrange(rng.choice([5, 30, 200, 1000])))
+    return "select name, status from {0} where objid in ({1})".format(
+        rng.choice(TABLES), ids)
+
+def _multi_line_select(rng):
+    return "SELECT p.objid, p.ra, p.decl, s.z\n" \
+        "  FROM photoobj p\n" \
+        "  JOIN specobj s ON s.objid = p.objid\n" \
+        " WHERE s.z > {0:.3f}\n" \
+        "   AND p.mag_r < {1:.2f}\n" \
+        " ORDER BY s.z DESC".format(rng.uniform(0, 2), rng.uniform(14, 22))
+
+def _insert(rng):
+    rows = ', '.join("({0}, '{1}', {2:.5f})".format(
+        rng.randint(1, 10 ** 9), rng.choice(['new', 'done', 'failed']),
+        rng.uniform(0, 1)) for i in xrange(rng.choice([1, 1, 10, 500])))
+    return "insert into {0} (objid, status, z) values {1}".format(
+        rng.choice(TABLES), rows)
+
+def _update(rng):
+    return "update {0} set status = '{1}' where objid = {2}".format(
+        rng.choice(TABLES), rng.choice(['new', 'done', 'failed']),
+        rng.randint(1, 10 ** 9))
+
+def _set(rng):
+    return rng.choice(["SET autocommit=0", "SET autocommit=1",
+                       "SET NAMES utf8", "SET sql_mode='ANSI'",
+                       "set @rowcount = {0}".format(rng.randint(0, 100))])
+
+def _load(rng):
+    return "LOAD DATA LOCAL INFILE '/tmp/upload_{0}.csv' INTO TABLE {1} " \
+        "FIELDS TERMINATED BY ','".format(rng.randint(1, 10 ** 6),
+                                          rng.choice(TABLES))
+
+def _admin(rng):
+    return rng.choice(["SHOW TABLES", "SHOW PROCESSLIST", "commit",
+                       "SELECT DATABASE()", "SELECT @@version_comment LIMIT 1",
+                       "select count(*) from information_schema.tables",
+                       "select user, host from mysql.user"])
+
+SHAPES = [(30, _point_select), (12, _range_select), (8, _in_list_select),
+          (6, _multi_line_select), (12, _insert), (6, _update), (10, _set),
+          (2, _load), (14, _admin)]
+
+def _choose_shape(rng, cumulative, total):
+    x = rng.uniform(0, total)
+    for weight, shape in cumulative:
+        if x <= weight:
+            return shape
+    return cumulative[-1][1]
+
+def user_host(user, host, ip):
+    """
+    Return a user_host value as the general_log table stores it
+    """
+    return '{0}[{0}] @ {1} [{2}]'.format(user, host, ip)
+
+def generate(rows, seed = 0, start = datetime.datetime(2013, 3, 14),
+             threads = 50):
+    """
+    Generator over @rows general_log tuples (in
+    Sources.GENERAL_LOG_COLUMNS order), the same ones for the same
+    @seed, starting at @start, from up to @threads client threads
+    connected at once
+    """
+    rng = random.Random(seed)
+    cumulative = []
+    total = 0
+    for weight, shape in SHAPES:
+        total += weight
+        cumulative.append((total, shape))
+
+    event_time = start
+    next_thread = 1
+    sessions = {}
+    # repeated statements, as from an application polling
+    recent = []
+    for i in xrange(rows):
+        if rng.random() < 0.3:
+            event_time += datetime.timedelta(microseconds =
+                                             rng.randint(0, 2000000))
+
+        if len(sessions) < threads and (not sessions or rng.random() < 0.05):
+            thread_id = next_thread
+            next_thread += 1
+            user = rng.choice(USERS)
+            sessions[thread_id] = [user, rng.randint(5, 500)]
+            yield (event_time, user_host(*user), thread_id, 0, 'Connect',
+                   '{0}@{1} on {2}'.format(user[0], user[1] or user[2],
+                                           rng.choice(DATABASES)))
+            continue
+
+        thread_id = rng.choice(sessions.keys())
+        session = sessions[thread_id]
+        session[1] -= 1
+        if session[1] <= 0:
+            del sessions[thread_id]
+            yield (event_time, user_host(*session[0]), thread_id, 0, 'Quit',
+                   '')
+            continue
+
+        if rng.random() < 0.03:
+            command, argument = 'Init DB', rng.choice(DATABASES)
+        elif recent and rng.random() < 0.2:
+            command, argument = 'Query', rng.choice(recent)
+        else:
+            command = 'Query'
+            argument = _choose_shape(rng, cumulative, total)(rng)
+            if len(argument) < 200:
+                if len(recent) < 100:
+                    recent.append(argument)
+                else:
+                    recent[rng.randrange(100)] = argument
+        yield (event_time, user_host(*session[0]), thread_id, 0, command,
+               argument)
+
+def write_log(entries, outfile):
+    """
+    Write @entries, general_log tuples, to @outfile in the format of a
+    mysqld (< 5.6) general query log file
+    """
+    outfile.write("/usr/sbin/mysqld, Version: 5.5.30-log (MySQL Community "
+                  "Server (GPL)). started with:\n"
+                  "Tcp port: 3306  Unix socket: /var/run/mysqld/mysqld.sock\n"
+                  "Time                 Id Command    Argument\n")
+    last_time = None
+    for event_time, user_host, thread_id, server_id, command, argument \
+            in entries:
+        stamp = event_time.replace(microsecond = 0)
+        if stamp != last_time:
+            prefix = stamp.strftime('%y%m%d %H:%M:%S\t')
+            last_time = stamp
+        else:
+            prefix = '\t\t'
+        outfile.write('{0}{1:>6} {2}\t{3}\n'.format(prefix, thread_id, command,
+                                                    argument))
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1])
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    with open(sys.argv[2], 'w') as outfile:
+        write_log(generate(rows, seed), outfile)
@@ -0,0 +1,97 @@
+"""
+Run the Job from example.py over a synthetic general_log (see
+general_log_gen.py), with no MySQL server, and report the throughput
+and peak memory of each stage and step of the pipeline.
+
+Rows are generated on the fly (an in-memory source), or written to a
+general query log file first and read back through
+GeneralLogFileSource (--source file). Output is thrown away by a
+NullSink, so loading is not measured.
+
+Run from the top of the repository:
+
+    python benchmarks/pipeline_bench.py [--rows N] [--source memory|file]
+        [--seed S] [--chunk-size N] [--workers N]
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from general_log_gen import generate, write_log
+from example import make_job
+from Sources import MemorySource, GeneralLogFileSource
+from Sinks import NullSink
+
+def rate(rows, seconds):
+    if seconds <= 0:
+        return float('inf')
+    return rows / seconds
+
+def print_report(report):
+    print "{0}: {1} rows read in {2:.2f}s ({3:.0f} rows/sec), " \
+        "{4:.2f}s CPU, peak RSS {5} KB".format(
+            report['table'], report['rows_read'], report['wall_time'],
+            rate(report['rows_read'], report['wall_time']),
+            report['cpu_time'], report['max_rss_kb'])
+    print
+    print "{0:<40} {1:>10} {2:>9} {3:>12} {4:>12}".format(
+        'stage', 'rows', 'wall (s)', 'rows/sec', 'peak RSS KB')
+    for stage in report['stages']:
+        print "{0:<40.40} {1:>10} {2:>9.3f} {3:>12.0f} {4:>12}".format(
+            stage['name'], stage['rows'], stage['wall_time'],
+            rate(stage['rows'], stage['wall_time']), stage['max_rss_kb'])
+    print
+    print "{0:<40} {1:>10} {2:>10} {3:>9} {4:>12}".format(
+        'step', 'rows in', 'rejected', 'wall (s)', 'rows/sec')
+    for step in report['steps']:
+        print "{0:<40.40} {1:>10} {2:>10} {3:>9.3f} {4:>12.0f}".format(
+            '{0} {1}'.format(step['kind'], step['name']), step['rows_in'],
+            step['rejected'], step['wall_time'],
+            rate(step['rows_in'], step['wall_time']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type = int, default = 100000)
+    parser.add_argument('--source', choices = ['memory', 'file'],
+                        default = 'memory')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--chunk-size', type = int, default = 5000)
+    parser.add_argument('--workers', type = int, default = 1,
+                        help = 'group_workers for the Job')
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        if args.source == 'file':
+            path = os.path.join(temp_dir, 'bench.log')
+            start = time.time()
+            with open(path, 'w') as outfile:
+                write_log(generate(args.rows, args.seed), outfile)
+            print "Wrote {0} rows to {1} in {2:.2f}s".format(
+                args.rows, path, time.time() - start)
+            source = GeneralLogFileSource([path])
+        else:
+            source = MemorySource({'bench': lambda: generate(args.rows,
+                                                             args.seed)})
+
+        profile_dir = os.path.join(temp_dir, 'profile')
+        job = make_job(profile_dir = profile_dir, chunk_size = args.chunk_size,
+                       group_workers = args.workers)
+        sink = NullSink()
+        job.run(target_db = None, source = source, sinks = [sink])
+
+        for table in sorted(sink.rows):
+            with open(os.path.join(profile_dir, table + '.json')) as infile:
+                report = json.load(infile)
+            print
+            print_report(report)
+            print
+            print "{0} rows written".format(sink.rows[table])
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors = True)
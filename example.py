@@ -1,5 +1,5 @@
-from Prefilters import unwanted_terms_prefilter
-from Processors import UserHostIpProcessor, CleanProcessor, UnwantedStartsProcessor, IgnoreQueriesProcessor, SimpleQueryTypeProcessor, RegexReplaceProcessor, RemoveInsertValuesProcessor, ReplaceConstantsProcessor
+from Prefilters import unwanted_terms_prefilter, command_type_prefilter
+from Processors import UserHostIpProcessor, CleanProcessor, RejectQueriesProcessor, SimpleQueryTypeProcessor, RegexReplaceProcessor, RemoveInsertValuesProcessor, ReplaceConstantsProcessor
 from Job import Job
 from myutils import querytypes
 
@@ -10,7 +10,11 @@ This simple example runs a job that processes the 'test_general_log'
 database, storing into the 'test_processed_log' database.
 """
 
-if __name__ == '__main__':
+def make_job(**options):
+    """
+    Return the example Job; @options are passed on to Job() (see
+    benchmarks/pipeline_bench.py)
+    """
 
     # Define a Processor to replace long runs of digits with '<numlist
     # len=##>'. This Processor will be passed to the Job when we
@@ -22,34 +26,43 @@ if __name__ == '__main__':
                                                   .format(x.group(0).count(',') + 1))
 
     # create the Job
-    j = Job(selectors = ["command_type in ('Execute', 'Query')"],
-            prefilters = [unwanted_terms_prefilter(["information_schema",
-                                                    "mysql"],
-                                                   flags = re.I),
-                      ],
-            processors = [numlist_sub_processor,
-                          UserHostIpProcessor(users_reject=['buildbot', 'root']),
-                          CleanProcessor(),
-                          UnwantedStartsProcessor(["SHOW",
-                                                   "SET sql_mode",
-                                                   "SET NAMES",
-                                                   "SET character_set_results"]),
-                          IgnoreQueriesProcessor(["SELECT DATABASE()",
-                                                  "commit",
-                                                  "SET autocommit=0",
-                                                  "SET autocommit=1",
-                                                  "SELECT @@version_comment LIMIT 1"]),
-                          SimpleQueryTypeProcessor(),
-                          RemoveInsertValuesProcessor(),
-                          ReplaceConstantsProcessor(),
+    return Job(prefilters = [command_type_prefilter(['Execute', 'Query']),
+                             unwanted_terms_prefilter(["information_schema",
+                                                       "mysql"],
+                                                      flags = re.I),
+                         ],
+               processors = [UserHostIpProcessor(users_reject=['buildbot', 'root']),
+                             CleanProcessor(),
+                             # one scan of each query for both kinds
+                             # of rule
+                             RejectQueriesProcessor(starts = ["SHOW",
+                                                              "SET sql_mode",
+                                                              "SET NAMES",
+                                                              "SET character_set_results"],
+                                                    queries = ["SELECT DATABASE()",
+                                                               "commit",
+                                                               "SET autocommit=0",
+                                                               "SET autocommit=1",
+                                                               "SELECT @@version_comment LIMIT 1"]),
+                             # 'query' only exists once CleanProcessor
+                             # has run
+                             numlist_sub_processor,
+                             SimpleQueryTypeProcessor(),
+                             RemoveInsertValuesProcessor(),
+                             ReplaceConstantsProcessor(),
+                         ],
+               outputs = [('event_time', 'TIMESTAMP'),
+                          ('user', 'MEDIUMTEXT'),
+                          ('host', 'MEDIUMTEXT'),
+                          ('query_type', 'ENUM{0}'.format(querytypes)),
+                          ('query', 'MEDIUMTEXT'),
+                          ('vals', 'MEDIUMTEXT'),
                       ],
-            outputs = [('event_time', 'TIMESTAMP'),
-                       ('user', 'MEDIUMTEXT'),
-                       ('host', 'MEDIUMTEXT'),
-                       ('query_type', 'ENUM{0}'.format(querytypes)),
-                       ('query', 'MEDIUMTEXT'),
-                       ('vals', 'MEDIUMTEXT'),
-                   ])
-                    
+               **options)
+
+if __name__ == '__main__':
+
+    j = make_job()
+
     # run the Job
     j.run('test_processed_log', source_db = 'test_general_log')
@@ -1,9 +1,15 @@
-import MySQLdb as mysql
+import os
 import re
 import sys
 import string
 import json
 import time
+import datetime
+import heapq
+import resource
+import tempfile
+import cPickle as pickle
+from collections import OrderedDict
 
 # it is important that this order be maintained throughout all code
 querytypes = ('INSERT', 'SELECT', 'CREATE_TABLE', 'SET', 'LOAD', 'ALTER', 'OTHER')
@@ -35,6 +41,26 @@ def define_time_functions(cur):
                    RETURNS INT DETERMINISTIC
                    RETURN FLOOR( UNIX_TIMESTAMP(e) / (60 * 60) )""")
 
+# Python equivalents of the functions above, for bucketing datetimes
+# outside MySQL (UNIX_TIMESTAMP() is in local time, as is mktime())
+def my_year(e):
+    return e.year
+
+def my_month(e):
+    return e.year * 12 + e.month - 1
+
+def my_week(e):
+    return e.year * 53 + e.isocalendar()[1]
+
+def my_day(e):
+    return int(time.mktime(e.timetuple()) // (24 * 60 * 60))
+
+def my_hour(e):
+    return int(time.mktime(e.timetuple()) // (60 * 60))
+
+time_buckets = {'my_year': my_year, 'my_month': my_month, 'my_week': my_week,
+                'my_day': my_day, 'my_hour': my_hour}
+
 def printlist(lst, skiplines=False):
     """convenience fcn for printing a list (helpful from command line)"""
     for l in lst:
@@ -42,14 +68,90 @@ def printlist(lst, skiplines=False):
         if skiplines: print "\n"
     # print ("\n" if skiplines else "").join(lst); #untested but slightly prettier/more Pythonic
 
-def print_and_execute(query, cur):
+def print_and_execute(query, cur, params=None):
     print "Executing:"
     print query
     starttime = time.time()
-    cur.execute(query)
+    cur.execute(query, params or None)
     print "Query executed in {0} sec".format(time.time() - starttime)
 
 
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def data_path(filename):
+    """
+    Return the path of the data file @filename, relative to the
+    directory of this package unless it is absolute
+    """
+    return os.path.join(PACKAGE_DIR, filename)
+
+# Resources shared by everything in a process (keyword sets, compiled
+# patterns, cleaners), created on first use. Forked workers inherit
+# what is already loaded, and load the rest themselves.
+_resources = {}
+
+def shared_resource(key, factory):
+    """
+    Return the resource registered under @key, creating it by calling
+    @factory() if there is none yet
+    """
+    try:
+        return _resources[key]
+    except KeyError:
+        value = _resources[key] = factory()
+        return value
+
+def reset_resources():
+    """
+    Forget every shared resource, so that each is created again on
+    next use (after a keyword file has changed, say)
+    """
+    _resources.clear()
+
+def keywords(filename = 'mysql_keywords.txt'):
+    """
+    Return the shared set of words in the data file @filename (see
+    get_reserved_words())
+    """
+    path = data_path(filename)
+    return shared_resource(('keywords', path),
+                           lambda: frozenset(get_reserved_words(path)))
+
+def pattern(regex, flags = 0):
+    """
+    Return the shared compiled form of @regex
+    """
+    return shared_resource(('pattern', regex, flags),
+                           lambda: re.compile(regex, flags))
+
+class lazy_resource(object):
+    """
+    Attribute whose value is computed by @factory(instance) on first
+    access and then kept in the instance's __dict__. Objects with such
+    attributes drop them when pickled (see lazy_getstate()), so that
+    they are pickled by reference to the shared resources they use
+    rather than by value.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.name = factory.__name__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.name] = self.factory(instance)
+        return value
+
+def lazy_getstate(obj):
+    """
+    Return a copy of @obj's __dict__ without the values of its
+    lazy_resource attributes, for use as __getstate__
+    """
+    cls = type(obj)
+    return dict((name, value) for name, value in obj.__dict__.iteritems()
+                if not isinstance(getattr(cls, name, None), lazy_resource))
+
 def get_reserved_words(filename):
     """
     Generate a set of words from a file, one word per line
@@ -60,24 +162,79 @@ def get_reserved_words(filename):
         return set(line.strip() for line in infile.readlines())
 
 
+# Quoted strings and backquoted identifiers, which clean() leaves alone.
+# Each is written as an "unrolled loop" so that it matches in linear time.
+sql_literal_re = re.compile(r"('[^'\\]*(?:(?:\\.|'')[^'\\]*)*'"
+                            r'|"[^"\\]*(?:(?:\\.|"")[^"\\]*)*"'
+                            r"|`[^`]*(?:``[^`]*)*`)")
+
+class SQLCleaner(object):
+    """
+    Callable implementing clean() for one set of reserved words.
+
+    The query is split into quoted literals, which are kept verbatim,
+    and the text between them, which is split into words on whitespace
+    and rejoined with single spaces. Queries without any quotes (the
+    common case) skip the literal split. The upper-cased form of each
+    word seen is remembered, so repeated words cost one dict lookup.
+    """
+
+    max_memo = 1 << 16
+
+    def __init__(self, reserved_words):
+        self.reserved_words = reserved_words
+        self.memo = {}
+
+    def _word(self, word):
+        if len(self.memo) >= self.max_memo:
+            self.memo.clear()
+        upper = word.upper()
+        cased = self.memo[word] = upper if upper in self.reserved_words else word
+        return cased
+
+    def _words(self, text):
+        get = self.memo.get
+        cased = self._word
+        return ' '.join([get(word) or cased(word) for word in text.split()])
+
+    def __call__(self, query):
+        if "'" not in query and '"' not in query and '`' not in query:
+            return self._words(query)
+
+        parts = sql_literal_re.split(query.strip())
+        # even parts are between literals, odd parts are the literals
+        for i in xrange(0, len(parts), 2):
+            part = parts[i]
+            cleaned = self._words(part)
+            if part[:1].isspace():
+                cleaned = ' ' + cleaned
+            if part[-1:].isspace() and cleaned != ' ':
+                cleaned += ' '
+            parts[i] = cleaned
+        return ''.join(parts)
+
+def default_cleaner():
+    """
+    Return the shared SQLCleaner for the keywords in
+    mysql_keywords.txt, which are read the first time this is called
+    in a process
+    """
+    return shared_resource('default_cleaner',
+                           lambda: SQLCleaner(keywords()))
+
 def clean(query, reserved_words=None):
     """
     Transform queries into a standard format:
 
     1. Capitalize all keywords, as defined by @reserved_words
     2. replace all runs of whitespace with a single space character
+
+    Quoted strings and identifiers are left as they are.
     """
 
     if not reserved_words:
-        reserved_words = get_reserved_words('mysql_keywords.txt')
-
-    cleaned_query = query.strip()
-    cleaned_query = ' '.join([
-        (word.upper() if word.upper() in reserved_words else word)
-        for word in re.split('\s+', query)
-    ])
-    
-    return cleaned_query
+        return default_cleaner()(query)
+    return SQLCleaner(reserved_words)(query)
 
 user_host_re = re.compile(r".*\[(?P<uname>.*)\] @ (?P<server>.*) \[(?P<ip>.*)\]")
 def parse_user_host(user_host):
@@ -99,19 +256,343 @@ def parse_user_host(user_host):
         return '', ''
 
 
-const_re = re.compile(r'[<>=]+ *([-0-9.e]+)')
+# Constants replaced by repl_constants(): numbers (including scientific
+# notation) compared against with [<>=], hex literals, and quoted strings.
+# Backquoted identifiers are matched only so that they are skipped over.
+const_re = re.compile(r"""
+    (?P<op>[<>=]+\ *)(?P<num>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)(?![\w.])
+  | (?P<hex>\b0[xX][0-9a-fA-F]+\b|\b[xX]'[0-9a-fA-F]*')
+  | (?P<str>'[^'\\]*(?:(?:\\.|'')[^'\\]*)*'|"[^"\\]*(?:(?:\\.|"")[^"\\]*)*")
+  | (?P<ident>`[^`]*(?:``[^`]*)*`)
+""", re.X)
+
 def replace_constants(query, replchar='?'):
-    return const_re.sub(lambda x: x.group().replace(x.group(2), replchar), query)
+    return repl_constants(query, replchar)[0]
 
 def repl_constants(query, replchar = '?'):
+    """
+    Replace each constant in @query (see const_re) with @replchar, in a
+    single pass over the query. Returns the new query and the list of
+    constants replaced, in order. Quoted strings are returned with
+    their quotes.
+    """
     vals = []
-    for m in const_re.finditer(query):
-        vals.append(m.group(1))
-        # This would be a problem if the constant appeared elsewhere in the query:
-        # query = query.replace(m.group(2), replchar)
-        query = query.replace(m.group(), m.group().replace(m.group(1), replchar))
+    def repl(m):
+        num = m.group('num')
+        if num is not None:
+            vals.append(num)
+            return m.group('op') + replchar
+        ident = m.group('ident')
+        if ident is not None:
+            return ident
+        vals.append(m.group())
+        return replchar
+
+    return const_re.sub(repl, query), vals
+
+# characters which make a pattern more than a literal string
+regex_special_re = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+def trie_pattern(words):
+    """
+    Return a regex matching any of @words (literal strings), with
+    common prefixes factored out, so that the regex engine tries each
+    position of a string against one branch per character rather than
+    against every word in turn
+    """
+    root = {}
+    for word in words:
+        node = root
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def pattern(node):
+        branches = [re.escape(char) + pattern(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        if len(branches) == 1:
+            body = branches[0]
+        else:
+            body = '(?:' + '|'.join(branches) + ')'
+        if '' in node:
+            return '(?:' + body + ')?'
+        return body
+
+    return pattern(root)
+
+class RejectionEngine(object):
+    """
+    Decide, in one pass over a query, whether it starts with one of
+    @starts, contains one of @terms, or is exactly one of @queries.
+    Starts and terms are regexes or, usually, literal strings; each
+    kind is merged into a single regex, in which the literal strings
+    form a trie (see trie_pattern()), and exact queries are looked up
+    in a set. @flags apply to all of the patterns; with re.I, exact
+    queries are compared case-insensitively too.
+
+    hits counts the queries rejected by each rule, keyed by (kind,
+    pattern) with kind 'start', 'term' or 'query'.
+
+    The merged regexes are compiled on first use, as shared resources
+    (see pattern()).
+    """
+
+    __getstate__ = lazy_getstate
+
+    def __init__(self, starts = [], terms = [], queries = [], flags = 0):
+        self.flags = flags
+        self.ignore_case = bool(flags & re.I)
+        self.hits = {}
+
+        self.queries = dict((self._fold(query), ('query', query))
+                            for query in queries)
+        self.start_source, self.start_literals, self.start_regexes = \
+            self._merge('start', starts, r'\A(?:{0})')
+        self.term_source, self.term_literals, self.term_regexes = \
+            self._merge('term', terms, '{0}')
+
+    def _fold(self, s):
+        return s.lower() if self.ignore_case else s
+
+    def _merge(self, kind, patterns, wrap):
+        """
+        Return the merged regex for the @patterns of @kind, or None if
+        there are none, a dict from each (folded) literal pattern to its
+        rule, and a list of (regex, rule) for the other patterns
+        """
+        literals = {}
+        regexes = []
+        for regex in patterns:
+            if regex_special_re.search(regex):
+                regexes.append((regex, (kind, regex)))
+            else:
+                literals[self._fold(regex)] = (kind, regex)
+        alternatives = [regex for regex, rule in regexes]
+        if literals:
+            alternatives.insert(0, trie_pattern(literals))
+        if not alternatives:
+            return None, literals, regexes
+        return wrap.format('|'.join(alternatives)), literals, regexes
+
+    @lazy_resource
+    def start_re(self):
+        if self.start_source is None:
+            return None
+        return pattern(self.start_source, self.flags)
+
+    @lazy_resource
+    def term_re(self):
+        if self.term_source is None:
+            return None
+        return pattern(self.term_source, self.flags)
+
+    def rule(self, query):
+        """
+        Return the (kind, pattern) rule that rejects @query, or None
+        """
+        query = query or ''
+        if self.queries:
+            rule = self.queries.get(query.lower() if self.ignore_case
+                                    else query)
+            if rule is not None:
+                return rule
+        if self.start_re is not None:
+            m = self.start_re.match(query)
+            if m:
+                return self._which(m, 'start', self.start_literals,
+                                   self.start_regexes)
+        if self.term_re is not None:
+            m = self.term_re.search(query)
+            if m:
+                return self._which(m, 'term', self.term_literals,
+                                   self.term_regexes)
+        return None
+
+    def _which(self, m, kind, literals, regexes):
+        rule = literals.get(self._fold(m.group()))
+        if rule is not None:
+            return rule
+        # a pattern may depend on context outside the match, so test
+        # each regex on the whole query
+        for regex, rule in regexes:
+            regex = pattern(regex, self.flags)
+            test = regex.match if kind == 'start' else regex.search
+            if test(m.string):
+                return rule
+        return regexes[0][1] if regexes else (kind, m.group())
+
+    def rejects(self, query):
+        """
+        Return True, and count the hit, if @query is rejected
+        """
+        rule = self.rule(query)
+        if rule is None:
+            return False
+        self.hits[rule] = self.hits.get(rule, 0) + 1
+        return True
+
+    def keep_mask(self, queries):
+        """
+        Return a list of booleans, False for each of @queries that is
+        rejected
+        """
+        rejects = self.rejects
+        return [not rejects(query) for query in queries]
+
+    def stats(self):
+        """
+        Return a list of (hits, kind, pattern) for each rule that has
+        rejected something since the last reset(), most hits first
+        """
+        return sorted(((hits, kind, pattern)
+                       for (kind, pattern), hits in self.hits.iteritems()),
+                      reverse = True)
+
+    def reset(self):
+        """
+        Forget the hits counted so far
+        """
+        self.hits = {}
+
+class LRUCache(object):
+    """
+    Mapping holding at most @maxsize items, which evicts the least
+    recently used item to make room for a new one. Lookups through
+    get() are counted as hits or misses.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default = None):
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        data = self.data
+        if key in data:
+            del data[key]
+        elif len(data) >= self.maxsize:
+            data.popitem(last = False)
+        data[key] = value
+
+    def __len__(self):
+        return len(self.data)
+
+class _ReversedKey(object):
+    """
+    Wraps a sort key so that heapq, which pops the smallest item first,
+    pops the largest key first instead
+    """
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+def _spill_run(items, temp_dir, chunk_size = 1000):
+    """
+    Pickle @items to a new temporary file, @chunk_size items per pickle,
+    and return the file
+    """
+    runfile = tempfile.TemporaryFile(dir = temp_dir)
+    for i in xrange(0, len(items), chunk_size):
+        pickle.dump(items[i:i + chunk_size], runfile, pickle.HIGHEST_PROTOCOL)
+    runfile.seek(0)
+    return runfile
+
+def _read_run(runfile):
+    """
+    Generator over the items pickled to @runfile by _spill_run()
+    """
+    while True:
+        try:
+            chunk = pickle.load(runfile)
+        except EOFError:
+            return
+        for item in chunk:
+            yield item
+
+def external_sort(items, key, reverse = False, buffer_size = 1000000,
+                  temp_dir = None):
+    """
+    Generator yielding @items sorted by @key, holding no more than
+    @buffer_size items in memory at once. Each time the buffer fills
+    up it is sorted and spilled to a temporary file (in @temp_dir), and
+    the sorted runs are k-way merged back together at the end.
 
-    return query, vals
+    Like sorted(), the sort is stable, including when @reverse is True.
+    """
+    runs = []
+    buf = []
+    try:
+        for item in items:
+            buf.append(item)
+            if len(buf) >= buffer_size:
+                buf.sort(key = key, reverse = reverse)
+                runs.append(_spill_run(buf, temp_dir))
+                buf = []
+
+        buf.sort(key = key, reverse = reverse)
+        if not runs:
+            for item in buf:
+                yield item
+            return
+        if buf:
+            runs.append(_spill_run(buf, temp_dir))
+            buf = []
+
+        # Ties are broken by run number, and runs hold consecutive
+        # stretches of the input, so the merge is stable
+        wrap = _ReversedKey if reverse else lambda k: k
+        iters = [_read_run(runfile) for runfile in runs]
+        heap = []
+        for i, it in enumerate(iters):
+            for item in it:
+                heap.append((wrap(key(item)), i, item))
+                break
+        heapq.heapify(heap)
+
+        while heap:
+            _, i, item = heap[0]
+            yield item
+            for nxt in iters[i]:
+                heapq.heapreplace(heap, (wrap(key(nxt)), i, nxt))
+                break
+            else:
+                heapq.heappop(heap)
+    finally:
+        for runfile in runs:
+            runfile.close()
+
+def chunked(iterable, size):
+    """
+    Generator over lists of up to @size consecutive items of @iterable
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 def alpha_sequence():
     """
@@ -203,3 +684,192 @@ def partition_from_str(tablename):
     return "PARTITION {name} VALUES LESS THAN (TO_DAYS('{yr}-{mo}-01'))".format(name = tablename,
                                                                                 yr = yr,
                                                                                 mo = mo)
+
+def month_range(tablename):
+    """
+    Given a table name naming a month, as partition_from_str() expects
+    (eg '2010_04'), return the first moment of that month and of the
+    next as datetimes, or None if the name is not of that form
+    """
+    m = re.match(r'(\d{4})_(\d{1,2})$', tablename)
+    if not m:
+        return None
+    year, month = int(m.group(1)), int(m.group(2))
+    if not 1 <= month <= 12:
+        return None
+    if month == 12:
+        return datetime.datetime(year, 12, 1), datetime.datetime(year + 1, 1, 1)
+    return datetime.datetime(year, month, 1), \
+        datetime.datetime(year, month + 1, 1)
+
+def time_ranges(tablename, hours):
+    """
+    Return the event_time ranges, as (start, end) pairs of datetimes
+    (start included, end not), which split the month table @tablename
+    (see month_range()) into spans of @hours hours. The first range has
+    no start and the last no end (None), so that rows outside the month
+    are not lost. A table not named after a month is one range, (None,
+    None).
+    """
+    month = month_range(tablename)
+    if month is None:
+        return [(None, None)]
+    first, last = month
+    step = datetime.timedelta(hours = hours)
+    bounds = []
+    bound = first + step
+    while bound < last:
+        bounds.append(bound)
+        bound += step
+    starts = [None] + bounds
+    ends = bounds + [None]
+    return zip(starts, ends)
+
+def merge_sorted(iterables, key, reverse = False, tiebreak = None):
+    """
+    Generator merging @iterables, each already sorted by @key
+    (descending, if @reverse), into one sorted sequence. Items with
+    equal keys come out in (ascending) order of @tiebreak(item), if
+    @tiebreak is given, or else in the order of the iterables they come
+    from.
+    """
+    wrap = _ReversedKey if reverse else lambda k: k
+    tiebreak = tiebreak or (lambda item: 0)
+    iters = [iter(iterable) for iterable in iterables]
+    heap = []
+    for i, it in enumerate(iters):
+        for item in it:
+            heap.append((wrap(key(item)), tiebreak(item), i, item))
+            break
+    heapq.heapify(heap)
+    while heap:
+        k, t, i, item = heap[0]
+        yield item
+        for item in iters[i]:
+            heapq.heapreplace(heap, (wrap(key(item)), tiebreak(item), i, item))
+            break
+        else:
+            heapq.heappop(heap)
+
+class StepStats(object):
+    """
+    Running totals of the wall and CPU time spent in one step of a
+    Job (a Prefilter, a Processor or a Sink), and of the rows it was
+    given and passed on. If @profiler, a cProfile.Profile, is given,
+    one call to the step in every @sample is run under it.
+    """
+    __slots__ = ('kind', 'name', 'wall_time', 'cpu_time', 'calls',
+                 'rows_in', 'rows_out', 'profiler', 'sample', 'max_rss_kb')
+
+    def __init__(self, kind, name, profiler = None, sample = 1):
+        self.kind = kind
+        self.name = name
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.calls = 0
+        self.rows_in = 0
+        self.rows_out = 0
+        self.profiler = profiler
+        self.sample = sample
+        self.max_rss_kb = 0
+
+    def add(self, wall_start, cpu_start, rows_in, rows_out):
+        self.wall_time += time.time() - wall_start
+        self.cpu_time += time.clock() - cpu_start
+        self.calls += 1
+        self.rows_in += rows_in
+        self.rows_out += rows_out
+
+    def run(self, step, batch):
+        """
+        Return @step(@batch), a list of the rows of @batch to keep,
+        adding its cost to the totals
+        """
+        wall, cpu = time.time(), time.clock()
+        if self.profiler is not None and self.calls % self.sample == 0:
+            kept = self.profiler.runcall(step, batch)
+        else:
+            kept = step(batch)
+        self.add(wall, cpu, len(batch), len(kept))
+        return kept
+
+    def report(self):
+        return {'kind': self.kind, 'name': self.name,
+                'wall_time': self.wall_time, 'cpu_time': self.cpu_time,
+                'batches': self.calls, 'rows_in': self.rows_in,
+                'rows_out': self.rows_out,
+                'rejected': self.rows_in - self.rows_out}
+
+class PipelineProfile(object):
+    """
+    Where the time went while reducing one table: the time taken by
+    each stage of the pipeline (fetching rows, prefiltering, sorting,
+    each group of Processors) and by each step (see StepStats), the
+    total wall and CPU time, and the peak memory use of the process.
+
+    Stages are generators over batches of rows, each pulling from the
+    one before, so the time spent waiting on a stage includes the time
+    of every stage before it; report() subtracts that out. The peak
+    memory use reported for a stage is the peak up to the last batch
+    it produced.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.stages = []
+        self.steps = []
+        self.wall_start = time.time()
+        self.cpu_start = time.clock()
+
+    def step(self, kind, name, profiler = None, sample = 1):
+        """
+        Return a new StepStats for a step of the pipeline
+        """
+        stats = StepStats(kind, name, profiler, sample)
+        self.steps.append(stats)
+        return stats
+
+    def timed(self, name, batches):
+        """
+        Return a generator passing @batches through, timing how long
+        each one takes to arrive
+        """
+        stats = StepStats('stage', name)
+        self.stages.append(stats)
+        return self._timed(stats, iter(batches))
+
+    def _timed(self, stats, batches):
+        while True:
+            wall, cpu = time.time(), time.clock()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                stats.add(wall, cpu, 0, 0)
+                return
+            stats.add(wall, cpu, 0, len(batch))
+            stats.max_rss_kb = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss
+            yield batch
+
+    def report(self):
+        """
+        Return the profile as a dict, which can be dumped as JSON
+        """
+        stages = []
+        upstream_wall = upstream_cpu = 0.0
+        for stats in self.stages:
+            stages.append({'name': stats.name,
+                           'wall_time': stats.wall_time - upstream_wall,
+                           'cpu_time': stats.cpu_time - upstream_cpu,
+                           'rows': stats.rows_out,
+                           'max_rss_kb': stats.max_rss_kb})
+            upstream_wall, upstream_cpu = stats.wall_time, stats.cpu_time
+
+        return {'table': self.table,
+                'wall_time': time.time() - self.wall_start,
+                'cpu_time': time.clock() - self.cpu_start,
+                'max_rss_kb': resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss,
+                'rows_read': self.stages[0].rows_out if self.stages else 0,
+                'stages': stages,
+                'steps': [stats.report() for stats in self.steps]}
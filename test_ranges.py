@@ -0,0 +1,162 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from Exceptions import InvalidRangeException
+from Job import Job
+from Processors import BaseProcessor, CleanProcessor, LatencyProcessor
+from Sinks import NullSink
+from Sources import MemorySource
+
+try:
+    import pyarrow.parquet as pq
+    from Sinks import ParquetSink
+except ImportError:
+    pq = None
+
+MONTH = '2013_03'
+
+def make_rows(n = 3000):
+    """
+    @n general_log rows spread over the first six hours of MONTH, from a
+    handful of sessions
+    """
+    start = datetime(2013, 3, 1)
+    return [(start + timedelta(seconds = i * 7), 'u[u] @ h []', i % 5, 0,
+             'Query', 'SELECT {0}'.format(i)) for i in xrange(n)]
+
+class MemorySink(NullSink):
+    """
+    Keep the rows of each table in self.data, honouring span and replace
+    """
+
+    def __init__(self):
+        NullSink.__init__(self)
+        self.data = {}
+
+    def tables(self):
+        return self.data.keys()
+
+    def begin(self, table, outputs, append = False, span = None,
+              replace = False):
+        self.table = table
+        self.append = append
+        self.span = span
+        self.replace = replace
+        self.buffer = []
+
+    def write(self, rows):
+        self.buffer.extend(rows)
+
+    def commit(self):
+        rows = self.data.get(self.table, []) if self.append else []
+        if self.span is not None and self.replace:
+            column, start, end = self.span
+            rows = [row for row in rows if column is not None and
+                    not ((start is None or row[0] >= start) and
+                         (end is None or row[0] < end))]
+        self.data[self.table] = rows + self.buffer
+
+    def drop(self, table):
+        self.data.pop(table, None)
+
+class FailingJob(Job):
+    """
+    A Job whose range starting at @fail_at loads a few rows and fails
+    """
+
+    fail_at = datetime(2013, 3, 1, 2)
+
+    def _reduce_table(self, source, sinks, table, between = None,
+                      replace = False):
+        if between is not None and between[0] == self.fail_at:
+            for sink in sinks:
+                sink.begin(table, self.outputs, True,
+                           ('event_time',) + between, replace)
+                sink.write([(between[0], None, None)] * 3)
+                sink.commit()
+            raise RuntimeError("range failed")
+        return Job._reduce_table(self, source, sinks, table, between,
+                                 replace)
+
+class RangeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.checkpoint_file = os.path.join(self.temp_dir, 'ranges.ckpt')
+        self.source = MemorySource({MONTH: make_rows()})
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def job(self, job_class = Job, **options):
+        options.setdefault('checkpoint_file', self.checkpoint_file)
+        return job_class(processors = [CleanProcessor(),
+                                       LatencyProcessor(timeout = 3600)],
+                         outputs = [('event_time', 'TIMESTAMP'),
+                                    ('query', 'MEDIUMTEXT'),
+                                    ('latency', 'FLOAT')],
+                         **options)
+
+    def reference(self):
+        sink = MemorySink()
+        self.job(checkpoint_file = os.path.join(self.temp_dir, 'ref.ckpt'),
+                 range_hours = 1).run(source = self.source, sinks = [sink])
+        return sorted(sink.data[MONTH])
+
+    def test_needs_checkpoint_file(self):
+        self.assertRaises(InvalidRangeException, self.job,
+                          checkpoint_file = None, range_hours = 1)
+
+    def test_needs_event_time_sort(self):
+        processor = BaseProcessor()
+        processor.sort_column = 'thread_id'
+        processor.sort_reverse = False
+        processor.inputs = processor.outputs = []
+        self.assertRaises(InvalidRangeException, Job,
+                          processors = [processor],
+                          outputs = [('event_time', 'TIMESTAMP')],
+                          range_hours = 1,
+                          checkpoint_file = self.checkpoint_file)
+
+    def test_resume_after_failed_range(self):
+        sink = MemorySink()
+        results = self.job(FailingJob, range_hours = 1).run(
+            source = self.source, sinks = [sink])
+        self.assertTrue(results[MONTH])
+        # the ranges after the failed one wait for the next run
+        self.assertTrue(all(row[0] < FailingJob.fail_at + timedelta(hours = 1)
+                            for row in sink.data[MONTH]))
+
+        results = self.job(range_hours = 1).run(source = self.source,
+                                                 sinks = [sink])
+        self.assertEqual(results, {MONTH: None})
+        self.assertEqual(sorted(sink.data[MONTH]), self.reference())
+        job = self.job(range_hours = 1)
+        job._load_checkpoint()
+        self.assertEqual(job.checkpoint, {})
+
+    def test_resume_with_other_range_hours(self):
+        sink = MemorySink()
+        self.job(FailingJob, range_hours = 1).run(source = self.source,
+                                                 sinks = [sink])
+        results = self.job(range_hours = 2).run(source = self.source,
+                                                 sinks = [sink])
+        self.assertEqual(results, {MONTH: None})
+        self.assertEqual(sorted(sink.data[MONTH]), self.reference())
+
+    @unittest.skipIf(pq is None, "requires pyarrow")
+    def test_parquet_ranges_in_parallel(self):
+        directory = os.path.join(self.temp_dir, 'parquet')
+        results = self.job(range_hours = 1, workers = 3).run(
+            source = self.source, sinks = [ParquetSink(directory)])
+        self.assertEqual(results, {MONTH: None})
+        table_dir = os.path.join(directory, MONTH)
+        self.assertEqual(sum(pq.read_table(os.path.join(table_dir, name))
+                             .num_rows for name in os.listdir(table_dir)),
+                         len(make_rows()))
+
+if __name__ == '__main__':
+    unittest.main()